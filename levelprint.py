@@ -1,18 +1,34 @@
 import sys
 import struct
 from collections import namedtuple
-from time import sleep
+from collections.abc import Mapping
+from functools import cached_property
+from time import sleep, perf_counter
+from contextlib import redirect_stdout
+import traceback
 from pathlib import Path
 import os
-import io
 import zlib
-import math
+import gzip
+import base64
+import mmap
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
+import numpy as np
 from xml.etree.ElementTree import Element, SubElement, Comment, tostring
-from xml.dom import minidom
 from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
 
 import hashlib
+import json
+import re
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def _exit(msg):
     print(msg)
@@ -29,10 +45,57 @@ def _exit(msg):
 # str: filename
 # ]
 
-def prettifyXML(elem):
-    rough_string = ElementTree.tostring(elem, "utf8")
-    reparsed = minidom.parseString(rough_string)
-    return reparsed.toprettyxml(indent="  ")
+# Bump whenever the converters' output changes, so cached builds get redone
+CONVERTER_VERSION = 7
+
+# Remembers which inputs each step of a stage was last built from, keyed on
+# content hashes plus CONVERTER_VERSION and stored as JSON in the output folder
+class BuildCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = { }
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                cache = json.load(file)
+            if cache.get("version") == CONVERTER_VERSION:
+                self.entries = cache["entries"]
+
+    # A step is current when it was built from the same key and its outputs still exist
+    def is_current(self, step, key):
+        entry = self.entries.get(step)
+        if entry == None or entry["key"] != key:
+            return False
+        for output in entry["outputs"]:
+            if not os.path.exists(output):
+                return False
+        return True
+    def get(self, step):
+        return self.entries[step]["data"]
+    def set(self, step, key, data = None, outputs = []):
+        self.entries[step] = { "key": key, "data": data, "outputs": list(outputs) }
+    def save(self):
+        tempPath = self.path + ".tmp"
+        with open(tempPath, "w") as file:
+            json.dump({ "version": CONVERTER_VERSION, "entries": self.entries }, file)
+        os.replace(tempPath, self.path)
+
+# Writes an XML document one top-level child at a time, so only a single element (ie. a map layer)
+# has to be held in memory instead of the whole tree
+class XMLStreamWriter:
+    def __init__(self, file, root, indent = "  "):
+        self.file = file
+        self.root = root
+        self.indent = indent
+        attributes = "".join(" %s=%s" % (key, quoteattr(value)) for key, value in root.items())
+        self.file.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.file.write("<%s%s>\n" % (root.tag, attributes))
+    def write(self, elem):
+        ElementTree.indent(elem, self.indent, level=1)
+        elem.tail = "\n"
+        self.file.write(self.indent)
+        ElementTree.ElementTree(elem).write(self.file, encoding="unicode")
+    def close(self):
+        self.file.write("</%s>\n" % (self.root.tag))
 
 
 """
@@ -91,179 +154,505 @@ def prettifyXML(elem):
     }
 """
 
+WFLZ_BLOCK_SIZE = 4
+WFLZ_MIN_MATCH_LEN = WFLZ_BLOCK_SIZE + 1
+WFLZ_MAX_MATCH_LEN = (0xFF - 1) + WFLZ_MIN_MATCH_LEN
+WFLZ_MAX_SEQUENTIAL_LITERALS = 0xFF
+
+WFLZ_HEADER = struct.Struct("III")
+WFLZ_BLOCK = struct.Struct("HBB")
+WFLZ_SIGNATURE = struct.unpack("I", b"WFLZ")[0]
+# Chunked container, see wfLZ_CompressChunked: header, one offset per chunk
+# (relative to the start of the header), then a regular wfLZ stream per chunk
+WFLZ_HEADER_CHUNKED = struct.Struct("IIII")
+WFLZ_CHUNKED_SIGNATURE = struct.unpack("I", b"ZLFW")[0]
+WFLZ_MAX_DIST = 0xFFFF
+
+# Compression levels
+WFLZ_LEVEL_FAKE = 0     # Literals only, same output layout as CompressFake
+WFLZ_LEVEL_FAST = 1
+WFLZ_LEVEL_DEFAULT = 2
+WFLZ_LEVEL_BEST = 3     # Best ratio
+# (max hash chain steps, longest match whose inner positions get indexed, lazy matching)
+WFLZ_LEVEL_PARAMS = [
+    (0, 0, False),
+    (1, 0, False),
+    (16, 32, False),
+    (256, WFLZ_MAX_MATCH_LEN, True),
+]
+
 class WFLZ:
     def decomp_bytearr(self, bytearr):
-        return bytearr
-    def comp_bytearr(self, bytearr):
-        print()
-        return bytearr
-    def decomp_file(self, file):
+        return self.decomp_buffer(bytearr)[0]
+    def is_chunked(self, buff, offset = 0):
+        return WFLZ_HEADER.unpack_from(buff, offset)[0] == WFLZ_CHUNKED_SIGNATURE
+    # Returns the (start, end) of every chunk stream inside a chunked container
+    def get_chunk_extents(self, buff, offset = 0):
+        buff = memoryview(buff)
+        numChunks = WFLZ_HEADER_CHUNKED.unpack_from(buff, offset)[3]
+        chunkOffsets = struct.unpack_from("%dI" % numChunks, buff, offset + WFLZ_HEADER_CHUNKED.size)
+
+        extents = [None] * numChunks
+        for i in range(numChunks):
+            start = offset + chunkOffsets[i]
+            if i + 1 < numChunks:
+                end = offset + chunkOffsets[i + 1]
+            else:
+                end = min(len(buff), start + WFLZ_HEADER.size + WFLZ_HEADER.unpack_from(buff, start)[1])
+            extents[i] = (start, end)
+        return extents
+    # Yields the decompressed data chunk by chunk, a plain wfLZ stream is a
+    # single chunk. With workers > 1 chunks are decoded in a process pool,
+    # keeping at most a few chunks in flight per worker.
+    def decomp_chunks(self, buff, offset = 0, workers = 1):
+        buff = memoryview(buff)
+        if not self.is_chunked(buff, offset):
+            yield self.decomp_buffer(buff, offset)[0]
+            return
+
+        extents = self.get_chunk_extents(buff, offset)
+        if workers <= 1 or len(extents) <= 1:
+            for start, end in extents:
+                yield self.decomp_buffer(buff, start)[0]
+            return
+
+        with ProcessPoolExecutor(workers) as executor:
+            pending = deque()
+            for start, end in extents:
+                pending.append(executor.submit(_wflz_decomp_chunk, bytes(buff[start:end])))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+    # Same as decomp_chunks, but reads one chunk at a time from the file
+    def decomp_file_chunks(self, file):
         start_pos = file.tell()
 
-        wfLZ_Header = struct.unpack("III", file.read(0xC))
-        # wfLZ_HeaderChunked = struct.unpack("IIII", file.read(0x10))
+        wfLZ_HeaderChunked = WFLZ_HEADER_CHUNKED.unpack(file.read(WFLZ_HEADER_CHUNKED.size))
+        if wfLZ_HeaderChunked[0] != WFLZ_CHUNKED_SIGNATURE:
+            file.seek(start_pos)
+            yield self.decomp_file(file)
+            return
+
+        numChunks = wfLZ_HeaderChunked[3]
+        chunkOffsets = struct.unpack("%dI" % numChunks, file.read(numChunks * 4))
+        for i in range(numChunks):
+            file.seek(start_pos + chunkOffsets[i])
+            yield self.decomp_file(file)
+    def comp_bytearr(self, bytearr, level = WFLZ_LEVEL_DEFAULT):
+        src = bytes(bytearr)
+        srcLen = len(src)
+        maxChain, maxInsertLen, lazy = WFLZ_LEVEL_PARAMS[level]
+
+        dst = bytearray(WFLZ_HEADER.size)
+        packBlock = WFLZ_BLOCK.pack
+
+        # The first block only carries literals, its dist and length are ignored
+        blockPos = len(dst)
+        dst += packBlock(0, 0, 0)
+        litStart = 0
+
+        # Hash chains keyed on the next WFLZ_MIN_MATCH_LEN bytes, so every hit is a valid match
+        head = { }
+        prev = array("i", [-1]) * srcLen if maxChain > 1 else None
+
+        def insert(i):
+            key = src[i:i + WFLZ_MIN_MATCH_LEN]
+            if prev is not None:
+                prev[i] = head.get(key, -1)
+            head[key] = i
+
+        def findMatch(i):
+            bestLen = 0
+            bestDist = 0
+            limit = min(WFLZ_MAX_MATCH_LEN, srcLen - i)
+            cand = head.get(src[i:i + WFLZ_MIN_MATCH_LEN], -1)
+            steps = maxChain
+            while cand >= 0 and steps > 0 and i - cand <= WFLZ_MAX_DIST:
+                # Skip candidates that can't beat the current best
+                if bestLen == 0 or (bestLen < limit and src[cand + bestLen] == src[i + bestLen]):
+                    lo = WFLZ_MIN_MATCH_LEN
+                    hi = limit
+                    while lo < hi:
+                        mid = (lo + hi + 1) >> 1
+                        if src[cand + lo:cand + mid] == src[i + lo:i + mid]:
+                            lo = mid
+                        else:
+                            hi = mid - 1
+                    if lo > bestLen:
+                        bestLen = lo
+                        bestDist = i - cand
+                        if bestLen == limit:
+                            break
+                cand = prev[cand] if prev is not None else -1
+                steps -= 1
+            return bestLen, bestDist
+
+        lastKeyPos = srcLen - WFLZ_MIN_MATCH_LEN
+        i = 0 if maxChain > 0 else srcLen
+        while i <= lastKeyPos:
+            length, dist = findMatch(i)
+            insert(i)
+            if length == 0:
+                i += 1
+                continue
+            # Lazy matching: emit a literal if the next position has a longer match
+            if lazy and length < WFLZ_MAX_MATCH_LEN and i + 1 <= lastKeyPos and findMatch(i + 1)[0] > length:
+                i += 1
+                continue
+
+            self._emit_literals(dst, blockPos, src, litStart, i)
+            blockPos = len(dst)
+            dst += packBlock(dist, length - (WFLZ_MIN_MATCH_LEN - 1), 0)
+
+            if length <= maxInsertLen:
+                for j in range(i + 1, min(i + length, lastKeyPos + 1)):
+                    insert(j)
+            i += length
+            litStart = i
+
+        self._emit_literals(dst, blockPos, src, litStart, srcLen)
+
+        # End block
+        dst += packBlock(0, 0, 0)
+
+        WFLZ_HEADER.pack_into(dst, 0, WFLZ_SIGNATURE, len(dst) - WFLZ_HEADER.size, srcLen)
+        return dst
+    # Writes src[start:end] as literals, filling the still open block at
+    # blockPos first and adding literal-only blocks for the rest
+    def _emit_literals(self, dst, blockPos, src, start, end):
+        numCopy = min(end - start, WFLZ_MAX_SEQUENTIAL_LITERALS)
+        dst[blockPos + 3] = numCopy
+        dst += src[start:start + numCopy]
+        start += numCopy
+        while start < end:
+            numCopy = min(end - start, WFLZ_MAX_SEQUENTIAL_LITERALS)
+            dst += WFLZ_BLOCK.pack(0, 0, numCopy)
+            dst += src[start:start + numCopy]
+            start += numCopy
+    # Decodes a wfLZ stream starting at 'offset' of a bytes-like buffer,
+    # returns the decompressed bytearray and the offset just past the end block
+    def decomp_buffer(self, buff, offset = 0):
+        buff = memoryview(buff)
+
+        wfLZ_Header = WFLZ_HEADER.unpack_from(buff, offset)
         magic = wfLZ_Header[0]
+        if magic == WFLZ_CHUNKED_SIGNATURE:
+            return self._decomp_chunked_buffer(buff, offset)
         compressedSize = wfLZ_Header[1]
         decompressedSize = wfLZ_Header[2]
+        pos = offset + WFLZ_HEADER.size
 
-        firstBlock = struct.unpack("HBB", file.read(0x4))
-        # dist = firstBlock[0]
-        # length = firstBlock[1]
-        numLiterals = firstBlock[2]
+        # firstBlock's dist and length are unused
+        numLiterals = WFLZ_BLOCK.unpack_from(buff, pos)[2]
+        pos += WFLZ_BLOCK_SIZE
 
         dist = -1
-        len = -1
+        length = -1
 
         outarray = bytearray(decompressedSize)
         outindex = 0
 
-        WFLZ_BLOCK_SIZE = 4
-        WFLZ_MIN_MATCH_LEN = WFLZ_BLOCK_SIZE + 1
-        WFLZ_MAX_MATCH_LEN = (0xFF - 1) + WFLZ_MIN_MATCH_LEN
+        unpackBlock = WFLZ_BLOCK.unpack_from
 
+        # Slice assignments past the end would quietly resize outarray
         while 1:
             if numLiterals != 0:
-                while numLiterals > 0:
-                    outarray[outindex] = struct.unpack("B", file.read(0x1))[0]
-                    outindex += 1
-                    numLiterals -= 1
-            elif dist == 0 and len == 0:
-                return outarray
-
-            block = struct.unpack("HBB", file.read(0x4))
-            dist = block[0]
-            len = block[1]
-            numLiterals = block[2]
-
-            if len != 0:
-                cpySrc = outindex - dist;
-                len += WFLZ_MIN_MATCH_LEN - 1;
-                for i in range(len):
-                    outarray[outindex] = outarray[cpySrc + i]
-                    outindex += 1
+                if outindex + numLiterals > decompressedSize or pos + numLiterals > len(buff):
+                    raise ValueError("corrupt wfLZ stream")
+                outarray[outindex:outindex + numLiterals] = buff[pos:pos + numLiterals]
+                outindex += numLiterals
+                pos += numLiterals
+            elif dist == 0 and length == 0:
+                return outarray, pos
+
+            dist, length, numLiterals = unpackBlock(buff, pos)
+            pos += WFLZ_BLOCK_SIZE
+
+            if length != 0:
+                cpySrc = outindex - dist
+                length += WFLZ_MIN_MATCH_LEN - 1
+                if cpySrc < 0 or outindex + length > decompressedSize:
+                    raise ValueError("corrupt wfLZ stream")
+                if dist >= length:
+                    outarray[outindex:outindex + length] = outarray[cpySrc:cpySrc + length]
+                elif dist > 0:
+                    # Overlapping match, the output repeats the last 'dist' bytes
+                    pattern = outarray[cpySrc:outindex]
+                    outarray[outindex:outindex + length] = (pattern * (length // dist + 1))[:length]
+                else:
+                    for i in range(length):
+                        outarray[outindex + i] = outarray[cpySrc + i]
+                outindex += length
+    def _decomp_chunked_buffer(self, buff, offset):
+        decompressedSize = WFLZ_HEADER_CHUNKED.unpack_from(buff, offset)[2]
+
+        outarray = bytearray(decompressedSize)
+        outindex = 0
+        end_pos = offset + WFLZ_HEADER_CHUNKED.size
+        for start, end in self.get_chunk_extents(buff, offset):
+            chunk, end_pos = self.decomp_buffer(buff, start)
+            outarray[outindex:outindex + len(chunk)] = chunk
+            outindex += len(chunk)
+        return outarray, end_pos
+    def decomp_file(self, file):
+        start_pos = file.tell()
+
+        header = file.read(WFLZ_HEADER.size)
+        magic, compressedSize, decompressedSize = WFLZ_HEADER.unpack(header)
+        if magic == WFLZ_CHUNKED_SIGNATURE:
+            file.seek(start_pos)
+            outarray = bytearray()
+            for chunk in self.decomp_file_chunks(file):
+                outarray += chunk
+            return outarray
+
+        buff = header + file.read(compressedSize)
+
+        outarray, end_pos = self.decomp_buffer(buff)
+        # Leave the file right after the end block
+        file.seek(start_pos + end_pos)
         return outarray
     # Thanks Shane!
-    def comp_file(self, file):
-        return bytearray(0)
-
-def ReadType(file, type):
-    return struct.unpack(type, file.read({ "B": 1, "H": 2, "I": 4 }[type]))[0]
-def ReadTypeBE(file, type):
-    return struct.unpack(">" + type, file.read({ "B": 1, "H": 2, "I": 4 }[type]))[0]
-def ReadRSDKString(file):
-    return file.read(ReadType(file, "B")).decode("utf8").split('\0', 1)[0]
-def ReadString(file):
-    str = ""
-    bb = ReadType(file, "B")
-    while bb != 0:
-        str += "%c" % bb
-        bb = ReadType(file, "B")
-    return str
-def ReadCompressed(file, type):
-    compressedSize = ReadType(file, "I") - 4
-    decompressedSize = ReadTypeBE(file, "I")
-    buff = file.read(compressedSize)
-    buff = zlib.decompress(buff)
-
-    typesize = { "B": 1, "H": 2, "I": 4 }[type]
-    count = len(buff) / typesize
-
-    return struct.unpack(str(count) + type, buff)
-
-def WriteType(file, type, value):
-    file.write(struct.pack(type, value))
-def WriteTypeBE(file, type, value):
-    file.write(struct.pack(">" + type, value))
-def WriteRSDKString(file, value):
-    WriteType(file, "B", len(value))
-    file.write(bytearray(value, "utf8"))
-def WriteCompressed(file, type, value):
-    typesize = { "B": 1, "H": 2, "I": 4 }[type]
-
-    count = len(value)
-    decompressedSize = count * typesize
-    buff = struct.pack(str(count) + type, *value)
-    buff = zlib.compress(buff)
-
-    compressedSize = len(buff)
-    WriteType(file, "I", compressedSize + 4)
-    WriteTypeBE(file, "I", decompressedSize)
-    file.write(buff)
-
-def ROL4(n, d):
-    n &= 0xFFFFFFFF
-    return ((n << d) | (n >> (32 - d))) & 0xFFFFFFFF
-def ROR4(n, d):
-    n &= 0xFFFFFFFF
-    return ((n >> d) | (n << (32 - d)) & 0xFFFFFFFF) & 0xFFFFFFFF
+    def comp_file(self, file, level = WFLZ_LEVEL_DEFAULT):
+        return self.comp_bytearr(file.read(), level)
+
+def _wflz_decomp_chunk(chunk):
+    return WFLZ().decomp_bytearr(chunk)
+
+# struct.Struct objects are compiled once per format and reused
+STRUCT_CACHE = { }
+def GetStruct(format):
+    packer = STRUCT_CACHE.get(format)
+    if packer == None:
+        packer = STRUCT_CACHE[format] = struct.Struct(format)
+    return packer
+
+# Reads values from a buffer held in memory with cached structs, the RSDK classes read through this
+class BinaryReader:
+    def __init__(self, data, offset = 0):
+        self.data = data
+        self.offset = offset
+
+    def tell(self):
+        return self.offset
+    def read(self, format):
+        packer = GetStruct(format)
+        values = packer.unpack_from(self.data, self.offset)
+        self.offset += packer.size
+        return values
+    def read_type(self, type):
+        return self.read(type)[0]
+    def read_bytes(self, size):
+        value = bytes(self.data[self.offset:self.offset + size])
+        self.offset += size
+        return value
+    # 'count' records of 'format' as a list of tuples
+    def read_records(self, format, count):
+        packer = GetStruct(format)
+        end = self.offset + packer.size * count
+        records = list(packer.iter_unpack(self.data[self.offset:end]))
+        self.offset = end
+        return records
+    def read_rsdk_string(self):
+        return self.read_bytes(self.read_type("B")).decode("utf8").split('\0', 1)[0]
+    # zlib block prefixed by its size + 4 and its big-endian decompressed size, returned as an array of 'type'
+    def read_compressed(self, type):
+        compressedSize = self.read_type("I") - 4
+        decompressedSize = self.read_type(">I")
+        values = array(type)
+        values.frombytes(zlib.decompress(self.read_bytes(compressedSize)))
+        return values
+
+# Collects everything written into one buffer, which goes to the file in a single write
+class BinaryWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def tell(self):
+        return len(self.buffer)
+    def write(self, format, *values):
+        self.buffer += GetStruct(format).pack(*values)
+    def write_type(self, type, value):
+        self.write(type, value)
+    def write_bytes(self, value):
+        self.buffer += value
+    # Packs a batch of records (tuples of 'format') into space allocated up front
+    def write_records(self, format, records):
+        packer = GetStruct(format)
+        offset = len(self.buffer)
+        self.buffer += bytes(packer.size * len(records))
+        for record in records:
+            packer.pack_into(self.buffer, offset, *record)
+            offset += packer.size
+    def write_rsdk_string(self, value):
+        value = value.encode("utf8")
+        self.write_type("B", len(value))
+        self.buffer += value
+    # 'values' can also be an array or a NumPy array already holding 'type'
+    def write_compressed(self, type, values):
+        if not isinstance(values, (array, np.ndarray)):
+            values = array(type, values)
+        data = values.tobytes()
+        buff = zlib.compress(data)
+        self.write_type("I", len(buff) + 4)
+        self.write_type(">I", len(data))
+        self.buffer += buff
+    # Writes the buffer out, unless 'file' is this writer itself
+    def flush(self, file):
+        if file is not self:
+            file.write(self.buffer)
+
+# The file-level RSDK classes take either an open file or a BinaryReader/BinaryWriter
+def GetBinaryReader(file):
+    if isinstance(file, BinaryReader):
+        return file
+    return BinaryReader(file.read())
+def GetBinaryWriter(file):
+    if isinstance(file, BinaryWriter):
+        return file
+    return BinaryWriter()
+
 # The cleaner source: http://www.burtleburtle.net/bob/hash/doobs.html
+YCG_HASH_SEED = 123456789
+YCG_HASH_BLOCK = struct.Struct("<III")
+
 def YCG_Hash(string, length, initialHash):
+    M = 0xFFFFFFFF
     stringBytes = string.encode("utf8")
-    stringBuff = io.BytesIO(stringBytes)
+    unpackBlock = YCG_HASH_BLOCK.unpack_from
 
-    index = 0
-    hashA = (length + initialHash + 0xDEADBEEF) & 0xFFFFFFFF
-    hashB = (length + initialHash + 0xDEADBEEF) & 0xFFFFFFFF
-    hashC = (length + initialHash + 0xDEADBEEF) & 0xFFFFFFFF
+    hashA = hashB = hashC = (length + initialHash + 0xDEADBEEF) & M
 
+    pos = 0
     while length > 12:
-        sHashA = hashA
-        sHashB = hashB
-        sHashC = hashC
-        for i in range(min(length, 4)):
-            sHashC += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            sHashC &= 0xFFFFFFFF
-            length -= 1
-        for i in range(min(length, 4)):
-            sHashB += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            sHashB &= 0xFFFFFFFF
-            length -= 1
-        for i in range(min(length, 4)):
-            sHashA += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            sHashA &= 0xFFFFFFFF
-            length -= 1
-
-        a = (sHashC - sHashA + 0x100000000) ^ ROL4(sHashA, 4)
-        a1 = sHashB + sHashA
-        b = (sHashB - a + 0x100000000) ^ ROL4(a, 6)
-        b1 = a1 + a
-        c = (a1 - b + 0x100000000) ^ ROL4(b, 8)
-        c1 = b1 + b
-        d = (b1 - c + 0x100000000) ^ ROL4(c, 16)
-        d1 = c1 + c
-        e = (c1 - d + 0x100000000) ^ ROR4(d, 13)
-        hashC = d1 + d
-        hashA = (d1 - e + 0x100000000) ^ ROL4(e, 4)
-        hashB = hashC + e
-
-    if length <= 12:
-        for i in range(min(length, 4)):
-            hashC += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            hashC &= 0xFFFFFFFF
-            length -= 1
-        for i in range(min(length, 4)):
-            hashB += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            hashB &= 0xFFFFFFFF
-            length -= 1
-        for i in range(min(length, 4)):
-            hashA += ReadType(stringBuff, "B") << ((i & 3) << 3)
-            hashA &= 0xFFFFFFFF
-            length -= 1
+        c, b, a = unpackBlock(stringBytes, pos)
+        a = (hashA + a) & M
+        b = (hashB + b) & M
+        c = (hashC + c) & M
+
+        # mix
+        c = ((c - a) ^ ((a << 4) | (a >> 28))) & M
+        b1 = (b + a) & M
+        b = ((b - c) ^ ((c << 6) | (c >> 26))) & M
+        a = (b1 + c) & M
+        c = ((b1 - b) ^ ((b << 8) | (b >> 24))) & M
+        b1 = (a + b) & M
+        a = ((a - c) ^ ((c << 16) | (c >> 16))) & M
+        c1 = (b1 + c) & M
+        b = ((b1 - a) ^ ((a >> 13) | (a << 19))) & M
+        hashC = (c1 + a) & M
+        hashA = ((c1 - b) ^ ((b << 4) | (b >> 28))) & M
+        hashB = (hashC + b) & M
+
+        pos += 12
+        length -= 12
+
+    # Last block, zero padded
+    c, b, a = YCG_HASH_BLOCK.unpack(stringBytes[pos:pos + length].ljust(12, b"\0"))
+    hashA = (hashA + a) & M
+    hashB = (hashB + b) & M
+    hashC = (hashC + c) & M
 
     # Finish
-    a = (hashB ^ hashA) - ROL4(hashB, 14) + 0x100000000
-    a &= 0xFFFFFFFF
-    b = (hashC ^ a) - ROL4(a, 11) + 0x100000000
-    b &= 0xFFFFFFFF
-    c = (b ^ hashB) - ROR4(b, 7) + 0x100000000
-    c &= 0xFFFFFFFF
-    d = (c ^ a) - ROL4(c, 16) + 0x100000000
-    d &= 0xFFFFFFFF
-    e = (((b ^ d) - ROL4(d, 4) + 0x100000000) ^ c) - ROL4((b ^ d) - ROL4(d, 4) + 0x100000000, 14) + 0x100000000
-    e &= 0xFFFFFFFF
-    f = ((e ^ d) - ROR4(e, 8)) + 0x100000000
-    f &= 0xFFFFFFFF
+    a = ((hashB ^ hashA) - (((hashB << 14) | (hashB >> 18)) & M)) & M
+    b = ((hashC ^ a) - (((a << 11) | (a >> 21)) & M)) & M
+    c = ((b ^ hashB) - (((b >> 7) | (b << 25)) & M)) & M
+    d = ((c ^ a) - (((c << 16) | (c >> 16)) & M)) & M
+    e = ((b ^ d) - (((d << 4) | (d >> 28)) & M)) & M
+    e = ((e ^ c) - (((e << 14) | (e >> 18)) & M)) & M
+    f = ((e ^ d) - (((e >> 8) | (e << 24)) & M)) & M
     return f
+def YCG_HashMany(strings, initialHash = YCG_HASH_SEED):
+    return [YCG_Hash(string, len(string), initialHash) for string in strings]
+
+YCG_NAME_DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "YCGHashNames.json")
+
+# Hash -> name reverse lookup persisted as JSON, names already in it
+# never have to be hashed again
+class YCGNameDatabase:
+    def __init__(self, path = YCG_NAME_DATABASE_PATH):
+        self.path = path
+        self.names = { }
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                for hash, name in json.load(file).items():
+                    self.names[int(hash, 16)] = name
+        self.knownNames = set(self.names.values())
+
+    # Hashes the names that aren't in the database yet, returns how many were added
+    def add_names(self, names):
+        newNames = [name for name in dict.fromkeys(names) if not name in self.knownNames]
+        for name, hash in zip(newNames, YCG_HashMany(newNames)):
+            self.add(hash, name)
+        return len(newNames)
+    def add(self, hash, name):
+        if not hash in self.names:
+            self.names[hash] = name
+            self.knownNames.add(name)
+    def get(self, hash, default = None):
+        return self.names.get(hash, default)
+    def get_hash(self):
+        return hashlib.blake2b(json.dumps(sorted(self.names.items())).encode("utf8"), digest_size=16).hexdigest()
+
+    def save(self):
+        tempPath = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tempPath, "w") as file:
+            json.dump({ "%08X" % hash: self.names[hash] for hash in sorted(self.names.keys()) }, file, indent=0)
+        os.replace(tempPath, self.path)
+
+# The name databases only label output, failing to save one doesn't fail the stage
+def SaveNameDatabase(nameDatabase):
+    try:
+        nameDatabase.save()
+    except OSError as e:
+        print("Warning: Could not save the name database '%s': %s" % (nameDatabase.path, e))
+
+RSDK_NAME_DATABASE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RSDKHashNames.json")
+
+# MD5 hashes of RSDK class and property names, kept both ways so scenes that are read back get their names
+class RSDKNameDatabase:
+    def __init__(self, path = RSDK_NAME_DATABASE_PATH):
+        self.path = path
+        self.names = { }
+        self.hashes = { }
+        self.changed = False
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                for hash, name in json.load(file).items():
+                    self.names[bytes.fromhex(hash)] = name
+                    self.hashes[name] = bytes.fromhex(hash)
+
+    def add_names(self, names):
+        for name in names:
+            self.hash(name)
+    def hash(self, name):
+        hash = self.hashes.get(name)
+        if hash == None:
+            m = hashlib.md5()
+            m.update(name.encode("utf8"))
+            hash = m.digest()
+            self.names[hash] = name
+            self.hashes[name] = hash
+            self.changed = True
+        return hash
+    def get(self, hash, default = None):
+        return self.names.get(bytes(hash), default)
+
+    def save(self):
+        tempPath = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tempPath, "w") as file:
+            json.dump({ hash.hex().upper(): self.names[hash] for hash in sorted(self.names.keys()) }, file, indent=0)
+        os.replace(tempPath, self.path)
+        self.changed = False
+
+# Shared by every scene, loaded on first use
+RSDK_NAME_DATABASE = None
+def GetRSDKNameDatabase():
+    global RSDK_NAME_DATABASE
+    if RSDK_NAME_DATABASE == None:
+        RSDK_NAME_DATABASE = RSDKNameDatabase()
+    return RSDK_NAME_DATABASE
 
 class RSDK_SceneEditorMetadata:
     def __init__(self, file = None):
@@ -275,21 +664,18 @@ class RSDK_SceneEditorMetadata:
         self.UnusedByte2 = 0
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        self.UnusedByte1 = ReadType(file, "B")
-        self.BackgroundColor1 = ReadType(file, "I")
-        self.BackgroundColor2 = ReadType(file, "I")
-        self.UnknownBytes = file.read(7)
-        self.UnknownString = ReadRSDKString(file)
-        self.UnusedByte2 = ReadType(file, "B")
-    def Write(self, file):
-        WriteType(file, "B", self.UnusedByte1)
-        WriteType(file, "I", self.BackgroundColor1)
-        WriteType(file, "I", self.BackgroundColor2)
-        file.write(self.UnknownBytes)
-        WriteRSDKString(file, self.UnknownString)
-        WriteType(file, "B", self.UnusedByte2)
+    def Read(self, reader):
+        self.UnusedByte1, self.BackgroundColor1, self.BackgroundColor2 = reader.read("=BII")
+        self.UnknownBytes = reader.read_bytes(7)
+        self.UnknownString = reader.read_rsdk_string()
+        self.UnusedByte2 = reader.read_type("B")
+    def Write(self, writer):
+        writer.write("=BII", self.UnusedByte1, self.BackgroundColor1, self.BackgroundColor2)
+        writer.write_bytes(self.UnknownBytes)
+        writer.write_rsdk_string(self.UnknownString)
+        writer.write_type("B", self.UnusedByte2)
 class RSDK_ScrollInfo:
+    FORMAT = "HHBB"
     def __init__(self, file = None):
         self.RelativeSpeed = 0x0100
         self.ConstantSpeed = 0x0000
@@ -297,14 +683,17 @@ class RSDK_ScrollInfo:
         self.DrawLayer = 0
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        pack = struct.unpack("HHBB", file.read(0x6))
+    def Read(self, reader):
+        self.SetFields(reader.read(self.FORMAT))
+    def Write(self, writer):
+        writer.write(self.FORMAT, *self.Fields())
+    def Fields(self):
+        return (self.RelativeSpeed, self.ConstantSpeed, self.Behavior, self.DrawLayer)
+    def SetFields(self, pack):
         self.RelativeSpeed = pack[0]
         self.ConstantSpeed = pack[1]
         self.Behavior = pack[2]
         self.DrawLayer = pack[3]
-    def Write(self, file):
-        file.write(struct.pack("HHBB", self.RelativeSpeed, self.ConstantSpeed, self.Behavior, self.DrawLayer))
 class RSDK_SceneLayer:
     def __init__(self, width = 1, height = 1, file = None):
         self.UnusedByte1 = 0
@@ -317,15 +706,16 @@ class RSDK_SceneLayer:
         self.ConstantSpeed = 0x0000
         self.ScrollingInfo = [ RSDK_ScrollInfo() ]
         self.ScrollingIndexes = [ 0 ] * (self.Height * 16)
-        self.Tiles = [[0xFFFF] * self.Height for i in range(self.Width)]
+        # Row-major, indexed [y, x]
+        self.Tiles = np.full((self.Height, self.Width), 0xFFFF, dtype="<u2")
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        self.UnusedByte1 = ReadType(file, "B")
+    def Read(self, reader):
+        self.UnusedByte1 = reader.read_type("B")
 
-        self.Name = ReadRSDKString(file)
+        self.Name = reader.read_rsdk_string()
 
-        pack = struct.unpack("BBHHhhH", file.read(0xC))
+        pack = reader.read("BBHHhhH")
         self.Behaviour = pack[0];
         self.DrawFlag = pack[1];
         self.Width = pack[2];
@@ -335,157 +725,204 @@ class RSDK_SceneLayer:
 
         self.ScrollingInfo = [None] * pack[6];
         for i in range(len(self.ScrollingInfo)):
-            self.ScrollingInfo[i] = RSDK_ScrollInfo(file)
+            self.ScrollingInfo[i] = RSDK_ScrollInfo(reader)
 
-        self.ScrollingIndexes = ReadCompressed(file, "B")
+        self.ScrollingIndexes = reader.read_compressed("B")
 
-        tiles = ReadCompressed(file, "H")
-        self.Tiles = [[0xFFFF] * self.Height for i in range(self.Width)]
-        for i in range(len(tiles)):
-            self.Tiles[i % self.Width][i / self.Width] = tiles[i]
-    def Write(self, file):
-        WriteType(file, "B", self.UnusedByte1)
+        tiles = reader.read_compressed("H")
+        self.Tiles = np.frombuffer(tiles.tobytes(), dtype="<u2").reshape(self.Height, self.Width).copy()
+    def Write(self, writer):
+        writer.write_type("B", self.UnusedByte1)
 
-        WriteRSDKString(file, self.Name)
+        writer.write_rsdk_string(self.Name)
 
-        file.write(struct.pack("BBHHhhH", self.Behaviour, self.DrawFlag, self.Width, self.Height, self.RelativeSpeed, self.ConstantSpeed, len(self.ScrollingInfo)))
-        for i in range(len(self.ScrollingInfo)):
-            self.ScrollingInfo[i].Write(file)
+        writer.write("BBHHhhH", self.Behaviour, self.DrawFlag, self.Width, self.Height, self.RelativeSpeed, self.ConstantSpeed, len(self.ScrollingInfo))
+        writer.write_records(RSDK_ScrollInfo.FORMAT, [scrollInfo.Fields() for scrollInfo in self.ScrollingInfo])
 
-        WriteCompressed(file, "B", self.ScrollingIndexes)
+        writer.write_compressed("B", self.ScrollingIndexes)
 
-        tiles = [0xFFFF] * self.Height * self.Width
-        for i in range(len(tiles)):
-            tiles[i] = self.Tiles[int(i % self.Width)][int(i / self.Width)]
-        WriteCompressed(file, "H", tiles)
+        writer.write_compressed("H", np.ascontiguousarray(self.Tiles, dtype="<u2"))
 
 class RSDK_ObjectProperty:
+    FORMAT = "16sB"
     def __init__(self, file = None):
         self.Name = ""
         self.Hash = bytearray([ 0 ] * 16)
         self.Type = 0
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        self.Hash = file.read(0x10)
-        pack = struct.unpack("B", file.read(0x1))
-        self.Type = pack[0]
-    def Write(self, file):
+    def Read(self, reader):
+        self.Hash, self.Type = reader.read(self.FORMAT)
+        self.Name = GetRSDKNameDatabase().get(self.Hash, "")
+    def Write(self, writer):
+        writer.write(self.FORMAT, *self.Fields())
+    def Fields(self):
         if self.Name == "":
-            file.write(struct.pack("16sB", self.Hash, self.Type))
-        else:
-            m = hashlib.md5()
-            m.update(self.Name.encode("utf8"))
-            file.write(struct.pack("16sB", m.digest(), self.Type))
-class RSDK_ObjectEntity:
-    def __init__(self, pclass, file = None):
-        self.SlotID = 0
-        self.X = 0
-        self.Y = 0
-        self.Class = pclass
-        self.Values = [0] * len(self.Class.Properties)
-        if file != None:
-            self.Read(file)
-    def Read(self, file):
-        pack = struct.unpack("HII", file.read(0xA))
-        self.SlotID = pack[0]
-        self.X = pack[1]
-        self.Y = pack[2]
-
-        argTypes = {
-            0: "B",
-            1: "H",
-            2: "I",
-            3: "b",
-            4: "h",
-            5: "i",
-            6: "i",
-            7: "I",
-            11: "I",
-        }
-
-        for a in range(1, len(self.Class.Properties)):
-            type = self.Class.Properties[a].Type
-            if type == 8:
-                str = ""
-                len = ReadType(file, "H")
-                for s in range(len):
-                    str += "%c" % ReadType(file, "H")
-                self.Values[a] = str
-            elif type == 9:
-                self.Values[a] = [ ReadType(file, "I"), ReadType(file, "I") ]
-            else:
-                self.Values[a] = ReadType(file, argTypes[a])
-    def Write(self, file):
-        file.write(struct.pack("=HII", self.SlotID, self.X, self.Y))
-
-        argTypes = {
-            0: "=B",
-            1: "=H",
-            2: "=I",
-            3: "=b",
-            4: "=h",
-            5: "=i",
-            6: "=i",
-            7: "=I",
-            11: "=I",
-        }
-
-        for a in range(1, len(self.Class.Properties)):
-            type = self.Class.Properties[a].Type
-            if type == 8:
-                WriteType(file, "=H", len(self.Values[a]))
-                for s in range(len(self.Values[a])):
-                    WriteType(file, "=H", self.Values[a][s])
-            elif type == 9:
-                WriteType(file, "=I", self.Values[a][0])
-                WriteType(file, "=I", self.Values[a][1])
-            else:
-                WriteType(file, argTypes[type], self.Values[a])
+            return (bytes(self.Hash), self.Type)
+        return (GetRSDKNameDatabase().hash(self.Name), self.Type)
+
+# Property type -> struct type of its value, 8 (string) and 9 (two uint32s) are handled separately
+RSDK_ENTITY_ARG_TYPES = {
+    0: "B",
+    1: "H",
+    2: "I",
+    3: "b",
+    4: "h",
+    5: "i",
+    6: "i",
+    7: "I",
+    11: "I",
+}
+# Entities are stored column-wise: SlotIDs, X and Y hold one value per entity,
+# and Values one column per property (Values[0] stays unused like the Position property).
+# Columns are typed arrays, except strings (a list) and type 9 (two uint32s per entity in one array).
 class RSDK_SceneClass:
     def __init__(self, file = None):
         self.Hash = bytearray([ 0 ] * 16)
         self.Properties = [ RSDK_ObjectProperty() ]
         self.Properties[0].Type = 8; # Position
-        self.Entities = []
+        self.SlotIDs = array("H")
+        self.X = array("I")
+        self.Y = array("I")
+        self.Values = [ None ]
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        self.Hash = file.read(0x10)
+    def Read(self, reader):
+        self.Hash = reader.read_bytes(0x10)
 
-        self.Properties = [ None ] * ReadType(file, "B")
+        self.Properties = [ None ] * reader.read_type("B")
         # Position
         self.Properties[0] = RSDK_ObjectProperty()
         self.Properties[0].Type = 8;
         for a in range(1, len(self.Properties)):
-            self.Properties[a] = RSDK_ObjectProperty(file)
-
-        self.Entities = [ None ] * ReadType(file, "H")
-        for a in range(0, len(self.Entities)):
-            self.Entities[a] = RSDK_ObjectEntity(self, file)
-    def Write(self, file):
-        file.write(self.Hash)
-
-        WriteType(file, "B", len(self.Properties))
-        for a in range(1, len(self.Properties)):
-            self.Properties[a].Write(file)
-
-        WriteType(file, "H", len(self.Entities))
-        for a in range(0, len(self.Entities)):
-            self.Entities[a].Write(file)
+            self.Properties[a] = RSDK_ObjectProperty(reader)
+
+        count = reader.read_type("H")
+        entityFormat = self.GetEntityFormat()
+        if entityFormat != None and count > 0:
+            # Transpose the records into columns
+            columns = list(zip(*reader.read_records(entityFormat, count)))
+            self.SlotIDs = array("H", columns[0])
+            self.X = array("I", columns[1])
+            self.Y = array("I", columns[2])
+            self.Values = [ None ]
+            c = 3
+            for a in range(1, len(self.Properties)):
+                type = self.Properties[a].Type
+                if type == 9:
+                    column = array("I", [0]) * (count * 2)
+                    column[0::2] = array("I", columns[c])
+                    column[1::2] = array("I", columns[c + 1])
+                    c += 2
+                else:
+                    column = array(RSDK_ENTITY_ARG_TYPES[type], columns[c])
+                    c += 1
+                self.Values.append(column)
+        else:
+            self.SlotIDs = array("H")
+            self.X = array("I")
+            self.Y = array("I")
+            self.Values = [ None ] + [ self.NewColumn(property.Type, 0) for property in self.Properties[1:] ]
+            for e in range(count):
+                slotID, x, y = reader.read("=HII")
+                self.SlotIDs.append(slotID)
+                self.X.append(x)
+                self.Y.append(y)
+                for a in range(1, len(self.Properties)):
+                    type = self.Properties[a].Type
+                    if type == 8:
+                        # UTF-16 characters
+                        length = reader.read_type("=H")
+                        self.Values[a].append(reader.read_bytes(length * 2).decode("utf-16-le"))
+                    elif type == 9:
+                        self.Values[a].extend(reader.read("=II"))
+                    else:
+                        self.Values[a].append(reader.read_type("=" + RSDK_ENTITY_ARG_TYPES[type]))
+    def Write(self, writer):
+        writer.write_bytes(self.Hash)
+
+        writer.write_type("B", len(self.Properties))
+        writer.write_records(RSDK_ObjectProperty.FORMAT, [property.Fields() for property in self.Properties[1:]])
+
+        count = self.GetEntityCount()
+        writer.write_type("H", count)
+        entityFormat = self.GetEntityFormat()
+        if entityFormat != None:
+            # Transpose the columns into records
+            columns = [ self.SlotIDs, self.X, self.Y ]
+            for a in range(1, len(self.Properties)):
+                if self.Properties[a].Type == 9:
+                    columns += [ self.Values[a][0::2], self.Values[a][1::2] ]
+                else:
+                    columns.append(self.Values[a])
+            writer.write_records(entityFormat, list(zip(*columns)))
+        else:
+            for e in range(count):
+                writer.write("=HII", self.SlotIDs[e], self.X[e], self.Y[e])
+                for a in range(1, len(self.Properties)):
+                    type = self.Properties[a].Type
+                    if type == 8:
+                        value = self.Values[a][e].encode("utf-16-le")
+                        writer.write_type("=H", len(value) // 2)
+                        writer.write_bytes(value)
+                    elif type == 9:
+                        writer.write("=II", self.Values[a][e * 2], self.Values[a][e * 2 + 1])
+                    else:
+                        writer.write_type("=" + RSDK_ENTITY_ARG_TYPES[type], self.Values[a][e])
+
+    # Struct format of one entity, None when a string property makes their size vary
+    def GetEntityFormat(self):
+        format = "=HII"
+        for property in self.Properties[1:]:
+            if property.Type == 8:
+                return None
+            elif property.Type == 9:
+                format += "II"
+            else:
+                format += RSDK_ENTITY_ARG_TYPES[property.Type]
+        return format
+    # Empty column for 'count' entities of a property of 'type'
+    def NewColumn(self, type, count):
+        if type == 8:
+            return [ "" ] * count
+        elif type == 9:
+            return array("I", [0]) * (count * 2)
+        return array(RSDK_ENTITY_ARG_TYPES[type], [0]) * count
+    def GetEntityCount(self):
+        return len(self.X)
 
     def AddProperty(self, type, name):
         property = RSDK_ObjectProperty()
         property.Name = name
+        property.Hash = GetRSDKNameDatabase().hash(name)
         property.Type = type
         self.Properties.append(property)
+        self.Values.append(self.NewColumn(type, self.GetEntityCount()))
         return property
-    def AddEntity(self, x, y):
-        entity = RSDK_ObjectEntity(self)
-        entity.X = x
-        entity.Y = y
-        self.Entities.append(entity)
-        return entity
+    # Returns the new entity's index, 'values' are its property values in order (0 when left out)
+    def AddEntity(self, x, y, *values):
+        self.SlotIDs.append(0)
+        self.X.append(x)
+        self.Y.append(y)
+        for a in range(1, len(self.Properties)):
+            value = values[a - 1] if a - 1 < len(values) else None
+            type = self.Properties[a].Type
+            if type == 8:
+                self.Values[a].append(value if value != None else "")
+            elif type == 9:
+                self.Values[a].extend(value if value != None else (0, 0))
+            else:
+                self.Values[a].append(value if value != None else 0)
+        return self.GetEntityCount() - 1
+    def GetValue(self, index, a):
+        if self.Properties[a].Type == 9:
+            return list(self.Values[a][index * 2:index * 2 + 2])
+        return self.Values[a][index]
+    def SetValue(self, index, a, value):
+        if self.Properties[a].Type == 9:
+            self.Values[a][index * 2:index * 2 + 2] = array("I", value)
+        else:
+            self.Values[a][index] = value
 
 class RSDK_Scene:
     def __init__(self, file = None):
@@ -498,40 +935,53 @@ class RSDK_Scene:
         if file != None:
             self.Read(file)
     def Read(self, file):
-        self.Magic = ReadType(file, "I")
+        reader = GetBinaryReader(file)
+        self.Magic = reader.read_type("I")
+        if self.Magic != 0x4E4353:
+            raise ValueError("Not an RSDK scene file (magic 0x%X)" % (self.Magic))
 
-        self.EditorMetadata = RSDK_SceneEditorMetadata(file)
+        self.EditorMetadata = RSDK_SceneEditorMetadata(reader)
 
-        self.Layers = [ None ] * ReadType(file, "B")
+        self.Layers = [ None ] * reader.read_type("B")
         for i in range(len(self.Layers)):
-            self.Layers[i] = RSDK_SceneLayer(file)
+            self.Layers[i] = RSDK_SceneLayer(file = reader)
 
-        self.Classes = [ None ] * ReadType(file, "B")
+        self.Classes = [ None ] * reader.read_type("B")
+        self.ClassMap = {}
+        nameDatabase = GetRSDKNameDatabase()
         for i in range(len(self.Classes)):
-            self.Classes[i] = RSDK_SceneClass(file)
+            self.Classes[i] = RSDK_SceneClass(reader)
+            name = nameDatabase.get(self.Classes[i].Hash)
+            if name != None:
+                self.ClassMap[name] = self.Classes[i]
     def Write(self, file):
-        WriteType(file, "I", self.Magic)
+        writer = GetBinaryWriter(file)
+        writer.write_type("I", self.Magic)
 
-        self.EditorMetadata.Write(file)
+        self.EditorMetadata.Write(writer)
 
-        WriteType(file, "B", len(self.Layers))
+        writer.write_type("B", len(self.Layers))
         for i in range(len(self.Layers)):
-            self.Layers[i].Write(file)
+            self.Layers[i].Write(writer)
 
-        print("Object Definitions: 0x%X" % (file.tell()))
+        print("Object Definitions: 0x%X" % (writer.tell()))
 
-        WriteType(file, "B", len(self.Classes))
+        writer.write_type("B", len(self.Classes))
         for i in range(len(self.Classes)):
-            self.Classes[i].Write(file)
+            self.Classes[i].Write(writer)
+        writer.flush(file)
 
     def GetClass(self, name):
         # Add class if it doesn't exist
         if not name in self.ClassMap:
+            hash = GetRSDKNameDatabase().hash(name)
+            # Classes of a scene that was read back before their name was known
+            for scnClass in self.Classes:
+                if scnClass.Hash == hash:
+                    self.ClassMap[name] = scnClass
+                    return scnClass
             scnClass = RSDK_SceneClass()
-            # Hash name
-            m = hashlib.md5()
-            m.update(name.encode("utf8"))
-            scnClass.Hash = m.digest()
+            scnClass.Hash = hash
             # Add class to list and map
             self.Classes.append(scnClass)
             self.ClassMap[name] = scnClass
@@ -540,20 +990,24 @@ class RSDK_Scene:
         slotID = 0
         for i in range(len(self.Classes)):
             classE = self.Classes[i]
-            for a in range(len(classE.Entities)):
-                classE.Entities[a].SlotID = slotID
-                slotID += 1
+            count = classE.GetEntityCount()
+            classE.SlotIDs = array("H", range(slotID, slotID + count))
+            slotID += count
 
 class RSDK_PaletteColor:
+    FORMAT = "=BBB"
     def __init__(self, file = None):
         self.RGB = 0x000000
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        pack = struct.unpack("=BBB", file.read(3))
+    def Read(self, reader):
+        self.SetFields(reader.read(self.FORMAT))
+    def Write(self, writer):
+        writer.write(self.FORMAT, *self.Fields())
+    def Fields(self):
+        return (self.RGB & 0xFF, (self.RGB >> 8) & 0xFF, (self.RGB >> 16) & 0xFF)
+    def SetFields(self, pack):
         self.RGB = pack[0] | pack[1] << 8 | pack[2] << 16
-    def Write(self, file):
-        file.write(struct.pack("=BBB", self.RGB & 0xFF, (self.RGB >> 8) & 0xFF, (self.RGB >> 16) & 0xFF))
 class RSDK_Palette:
     def __init__(self, file = None):
         self.Colors = [ None ] * 16
@@ -563,38 +1017,40 @@ class RSDK_Palette:
                 self.Colors[i][j] = RSDK_PaletteColor()
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        palette_bitmask = ReadType(file, "=H")
+    def Read(self, reader):
+        palette_bitmask = reader.read_type("=H")
         for i in range(16):
             if (palette_bitmask & (1 << i)) != 0:
                 self.Colors[i] = [ None ] * 16
-                for j in range(16):
-                    self.Colors[i][j] = RSDK_PaletteColor(file)
+                for j, pack in enumerate(reader.read_records(RSDK_PaletteColor.FORMAT, 16)):
+                    self.Colors[i][j] = RSDK_PaletteColor()
+                    self.Colors[i][j].SetFields(pack)
             else:
                 self.Colors[i] = None
-    def Write(self, file):
+    def Write(self, writer):
         palette_bitmask = 0
         for i in range(16):
             if self.Colors[i] != None:
                 palette_bitmask |= 1 << i
-        WriteType(file, "=H", palette_bitmask)
+        writer.write_type("=H", palette_bitmask)
 
+        colors = [ ]
         for i in range(16):
             if self.Colors[i] != None:
-                for j in range(16):
-                    self.Colors[i][j].Write(file)
+                colors += [color.Fields() for color in self.Colors[i]]
+        writer.write_records(RSDK_PaletteColor.FORMAT, colors)
 class RSDK_WAVConfiguration:
     def __init__(self, file = None):
         self.Name = ""
         self.MaxConcurrentPlay = 0xFF
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        self.Name = ReadRSDKString(file)
-        self.MaxConcurrentPlay = ReadType(file, "=B")
-    def Write(self, file):
-        WriteRSDKString(file, self.Name)
-        WriteType(file, "=B", self.MaxConcurrentPlay)
+    def Read(self, reader):
+        self.Name = reader.read_rsdk_string()
+        self.MaxConcurrentPlay = reader.read_type("=B")
+    def Write(self, writer):
+        writer.write_rsdk_string(self.Name)
+        writer.write_type("=B", self.MaxConcurrentPlay)
 class RSDK_StageConfig:
     def __init__(self, file = None):
         self.Magic = 0x474643
@@ -607,35 +1063,39 @@ class RSDK_StageConfig:
         if file != None:
             self.Read(file)
     def Read(self, file):
-        self.Magic = ReadType(file, "I")
-        self.LoadGlobalObjects = ReadType(file, "B") != 0
+        reader = GetBinaryReader(file)
+        self.Magic = reader.read_type("I")
+        self.LoadGlobalObjects = reader.read_type("B") != 0
 
-        self.ClassNames = [ "" ] * ReadType(file, "B")
+        self.ClassNames = [ "" ] * reader.read_type("B")
         for i in range(len(self.ClassNames)):
-            self.ClassNames[i] = ReadRSDKString(file)
+            self.ClassNames[i] = reader.read_rsdk_string()
 
         for i in range(8):
-            self.Palettes[i] = RSDK_Palette(file)
+            self.Palettes[i] = RSDK_Palette(reader)
 
-        self.WAVConfigs = [ None ] * ReadType(file, "B")
+        self.WAVConfigs = [ None ] * reader.read_type("B")
         for i in range(len(self.WAVConfigs)):
-            self.WAVConfigs[i] = RSDK_WAVConfiguration(file)
+            self.WAVConfigs[i] = RSDK_WAVConfiguration(reader)
     def Write(self, file):
-        WriteType(file, "I", self.Magic)
-        WriteType(file, "B", self.LoadGlobalObjects)
+        writer = GetBinaryWriter(file)
+        writer.write_type("I", self.Magic)
+        writer.write_type("B", self.LoadGlobalObjects)
 
-        WriteType(file, "B", len(self.ClassNames))
+        writer.write_type("B", len(self.ClassNames))
         for i in range(len(self.ClassNames)):
-            WriteRSDKString(file, self.ClassNames[i])
+            writer.write_rsdk_string(self.ClassNames[i])
 
         for i in range(8):
-            self.Palettes[i].Write(file)
+            self.Palettes[i].Write(writer)
 
-        WriteType(file, "B", len(self.WAVConfigs))
+        writer.write_type("B", len(self.WAVConfigs))
         for i in range(len(self.WAVConfigs)):
-            self.WAVConfigs[i].Write(file)
+            self.WAVConfigs[i].Write(writer)
+        writer.flush(file)
 
 class RSDK_CollisionMask:
+    FORMAT = "=16s16sBBBBBB"
     def __init__(self, file = None):
         self.Collision = bytearray([0] * 16)
         self.HasCollision = bytearray([0] * 16)
@@ -647,8 +1107,13 @@ class RSDK_CollisionMask:
         self.Behavior = 0
         if file != None:
             self.Read(file)
-    def Read(self, file):
-        pack = struct.unpack("=16s16sBBBBBB", file.read(0x26))
+    def Read(self, reader):
+        self.SetFields(reader.read(self.FORMAT))
+    def Write(self, writer):
+        writer.write(self.FORMAT, *self.Fields())
+    def Fields(self):
+        return (bytes(self.Collision), bytes(self.HasCollision), self.IsCeiling, self.TopAngle, self.LeftAngle, self.RightAngle, self.BottomAngle, self.Behavior)
+    def SetFields(self, pack):
         self.Collision = pack[0]
         self.HasCollision = pack[1]
         self.IsCeiling = pack[2]
@@ -657,8 +1122,6 @@ class RSDK_CollisionMask:
         self.RightAngle = pack[5]
         self.BottomAngle = pack[6]
         self.Behavior = pack[7]
-    def Write(self, file):
-        file.write(struct.pack("=16s16sBBBBBB", self.Collision, self.HasCollision, self.IsCeiling, self.TopAngle, self.LeftAngle, self.RightAngle, self.BottomAngle, self.Behavior))
 class RSDK_TileConfig:
     def __init__(self, file = None):
         self.Magic = 0x4C4954
@@ -670,57 +1133,121 @@ class RSDK_TileConfig:
         if file != None:
             self.Read(file)
     def Read(self, file):
-        self.Magic = ReadType(file, "I")
-
-        compressedSize = ReadType(file, "I") - 4
-        decompressedSize = ReadTypeBE(file, "I")
-        buff = file.read(compressedSize)
-        buff = zlib.decompress(buff)
-        buff = io.BytesIO(buff)
-
-        for i in range(len(self.CollisionPath1)):
-            self.CollisionPath1[i] = RSDK_CollisionMask(buff)
-        for i in range(len(self.CollisionPath2)):
-            self.CollisionPath2[i] = RSDK_CollisionMask(buff)
+        reader = GetBinaryReader(file)
+        self.Magic = reader.read_type("I")
+
+        compressedSize = reader.read_type("I") - 4
+        decompressedSize = reader.read_type(">I")
+        buff = BinaryReader(zlib.decompress(reader.read_bytes(compressedSize)))
+
+        masks = buff.read_records(RSDK_CollisionMask.FORMAT, len(self.CollisionPath1) + len(self.CollisionPath2))
+        for i, pack in enumerate(masks):
+            mask = RSDK_CollisionMask()
+            mask.SetFields(pack)
+            if i < len(self.CollisionPath1):
+                self.CollisionPath1[i] = mask
+            else:
+                self.CollisionPath2[i - len(self.CollisionPath1)] = mask
     def Write(self, file):
-        WriteType(file, "I", self.Magic)
+        writer = GetBinaryWriter(file)
+        writer.write_type("I", self.Magic)
 
-        buff = io.BytesIO()
-
-        for i in range(len(self.CollisionPath1)):
-            self.CollisionPath1[i].Write(buff)
-        for i in range(len(self.CollisionPath2)):
-            self.CollisionPath2[i].Write(buff)
+        buff = BinaryWriter()
+        buff.write_records(RSDK_CollisionMask.FORMAT, [mask.Fields() for mask in self.CollisionPath1 + self.CollisionPath2])
 
         decompressedSize = (buff.tell()) * 0x26
-        buff.seek(0)
 
-        buffArrComp = zlib.compress(buff.read())
+        buffArrComp = zlib.compress(buff.buffer)
         compressedSize = len(buffArrComp)
-        WriteType(file, "I", compressedSize + 4)
-        WriteTypeBE(file, "I", decompressedSize)
-        file.write(buffArrComp)
-
-class LTBClass:
-    def __init__(self, ltb_file):
+        writer.write_type("I", compressedSize + 4)
+        writer.write_type(">I", decompressedSize)
+        writer.write_bytes(buffArrComp)
+        writer.flush(file)
+
+# Read-only list of records stored as one array per field, a record is only
+# built when it's indexed
+class ArrayRecordList:
+    def __init__(self, recordType, *columns):
+        self.recordType = recordType
+        self.columns = columns
+
+    def column(self, name):
+        return self.columns[self.recordType._fields.index(name)]
+
+    def __len__(self):
+        return len(self.columns[0])
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.recordType._make([column[index] for column in self.columns])
+    def __iter__(self):
+        return map(self.recordType._make, zip(*self.columns))
+
+class MappedFileClass:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.close()
+
+    # Either map the file or read it whole, the handle is closed right away
+    # and every table is decoded from (or is a view into) self.buffer
+    def open_buffer(self, path, use_mmap = True):
+        self.path = Path(path)
+        self.mmap = None
+        self.hash = None
+        with open(path, 'rb') as file:
+            if use_mmap:
+                self.mmap = self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = file.read()
+        self.buffer = memoryview(self.data)
+
+    # Decodes 'count' records starting at 'start' into a list of 'recordType'
+    def unpack_table(self, recordType, format, start, count):
+        end = start + struct.calcsize(format) * count
+        return list(map(recordType._make, struct.iter_unpack(format, self.buffer[start:end])))
+    # Copies 'count' scalars starting at 'start' into a compact array in one go,
+    # the array stays valid after close()
+    def array_table(self, typecode, start, count):
+        table = array(typecode)
+        table.frombytes(self.buffer[start:start + table.itemsize * count])
+        return table
+
+    # Content hash of the whole file
+    def get_hash(self):
+        if self.hash == None:
+            self.hash = hashlib.blake2b(self.buffer, digest_size=16).hexdigest()
+        return self.hash
+
+    # Views still alive (e.g. kept by an exception's traceback) keep the map open,
+    # it's then left to the garbage collector instead of hiding the real error
+    def close(self):
+        self.buffer.release()
+        if self.mmap != None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass
+            self.mmap = None
+
+class LTBClass(MappedFileClass):
+    def __init__(self, ltb_file, use_mmap = True):
         if ltb_file.suffix == '.ltb':
-            self.unpack(ltb_file)
+            self.unpack(ltb_file, use_mmap)
         else:
             _exit("Error: This is not a valid .LTB file!")
 
-    def unpack(self, ltb_file):
-        self.file = open(ltb_file, 'rb')
+    def unpack(self, ltb_file, use_mmap = True):
+        self.open_buffer(ltb_file, use_mmap)
 
-        file = self.file
         # path_hash = unpack(file, 4)
 
         # fpath = "levels/core/plainsOfPassage.ltb"
-        # print("File Hash: 0x%08X" % YCG_Hash(fpath, len(fpath), 123456789))
+        # print("File Hash: 0x%08X" % YCG_Hash(fpath, len(fpath), YCG_HASH_SEED))
 
         self.ltb_start = ltb_start = 0x10
-        file.seek(ltb_start)
 
-        layerFormatHeader = struct.unpack("IIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII", file.read(0x90))
+        layerFormatHeader = struct.unpack_from("IIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII", self.buffer, ltb_start)
 
         unk_0x00 = layerFormatHeader[0]
         unk_0x04 = layerFormatHeader[1]
@@ -744,6 +1271,8 @@ class LTBClass:
         attachedFileCount = layerFormatHeader[33]
         attachedFileOffset = layerFormatHeader[34]
 
+        self.tileSize = tileSize
+
         print("LayerFormat Header:")
         print("-------------------")
         print("Tile Size: %d" % tileSize)
@@ -767,106 +1296,124 @@ class LTBClass:
 
         # Layer Info List
         self.layerInfo = namedtuple("LayerInfo", "name nameHash unk1 unk2 cameraMultX unk3 cameraMultY unk4 unk5 unk6 unkI7 unkI8 unkI9 vertexBufferInfoIndex isUsingStaticVertexBuffer unkI10 chunkXCount chunkYCount chunkIDStart offsetX offsetY startX startY endX endY")
-        self.layerInfoList = [None] * layerInfoCount
-
-        file.seek(ltb_start + layerInfoOffset)
-        for i in range(layerInfoCount):
-            self.layerInfoList[i] = self.layerInfo._make(struct.unpack("32sIffffffffIIIIIIIIIffIIII", file.read(0x80)))
+        self.layerInfoList = self.unpack_table(self.layerInfo, "32sIffffffffIIIIIIIIIffIIII", ltb_start + layerInfoOffset, layerInfoCount)
 
         # Vertex Buffer Info List
         self.vertexBufferInfo = namedtuple("VertexBufferInfo", "unk1 textureIndex vertexCount unk4 unk5")
-        self.vertexBufferInfoList = [None] * vertexBufferInfoCount
-
-        file.seek(ltb_start + vertexBufferInfoOffset)
-        for i in range(vertexBufferInfoCount):
-            self.vertexBufferInfoList[i] = self.vertexBufferInfo._make(struct.unpack("IIIII", file.read(0x14)))
+        self.vertexBufferInfoList = self.unpack_table(self.vertexBufferInfo, "IIIII", ltb_start + vertexBufferInfoOffset, vertexBufferInfoCount)
 
         # Texture Format Info
         self.textureFormatInfo = namedtuple("TextureFormatInfo", "unk1 isCompressed width height unk2 unk3 unk4 unk5 unk6 unk7 unk8 unk9 unk10 unk11 unk12 unk13 unk14 unk15 size")
-        self.textureFormatInfoList = [None] * textureFormatInfoCount
-
-        file.seek(ltb_start + textureFormatInfoOffset)
-        for i in range(textureFormatInfoCount):
-            self.textureFormatInfoList[i] = self.textureFormatInfo._make(struct.unpack("IIIIfIiiiiiiiiiiiiI", file.read(0x4C)))
+        self.textureFormatInfoList = self.unpack_table(self.textureFormatInfo, "IIIIfIiiiiiiiiiiiiI", ltb_start + textureFormatInfoOffset, textureFormatInfoCount)
 
         # Chunk Infos
         self.chunkInfo = namedtuple("ChunkInfo", "tileBufferStart")
-        self.chunkInfoList = [None] * chunkCount
-
-        file.seek(ltb_start + chunkOffset)
-        for i in range(chunkCount):
-            self.chunkInfoList[i] = self.chunkInfo._make(struct.unpack("I", file.read(0x4)))
+        self.chunkInfoList = ArrayRecordList(self.chunkInfo, self.array_table("I", ltb_start + chunkOffset, chunkCount))
 
         # tileBuffer
-        self.tileBufferList = [0] * tileBufferCount
-
-        file.seek(ltb_start + tileBufferOffset)
-        for i in range(tileBufferCount):
-            self.tileBufferList[i] = struct.unpack("H", file.read(0x2))[0]
+        self.tileBufferList = self.array_table("H", ltb_start + tileBufferOffset, tileBufferCount)
 
         # self.uvPointList
         self.uvPoint = namedtuple("UVPoint", "u1 v1 u2 v2")
-        self.uvPointList = [None] * uvPointCount
-
-        file.seek(ltb_start + uvPointOffset)
-        for i in range(int(uvPointCount / 2)):
-            self.uvPointList[i] = self.uvPoint._make(struct.unpack("ffff", file.read(0x10)))
+        self.uvPointList = self.unpack_table(self.uvPoint, "ffff", ltb_start + uvPointOffset, int(uvPointCount / 2))
+        self.uvPointList += [None] * (uvPointCount - len(self.uvPointList))
 
         # Static Vertex Data List
         self.staticVertexData = namedtuple("StaticVertexData", "x y z u v")
-        self.staticVertexDataList = [None] * staticVertexDataCount
-
-        file.seek(ltb_start + staticVertexDataOffset)
-        for i in range(staticVertexDataCount):
-            self.staticVertexDataList[i] = self.staticVertexData._make(struct.unpack("fffff", file.read(0x14)))
+        self.staticVertexDataArray = self.array_table("f", ltb_start + staticVertexDataOffset, staticVertexDataCount * 5)
+        # Strided views into staticVertexDataArray, vertices are only built when indexed
+        vertexView = memoryview(self.staticVertexDataArray)
+        self.staticVertexDataList = ArrayRecordList(self.staticVertexData, *[vertexView[i::5] for i in range(5)])
 
         # Attached File Offset List
-        self.attachedFileList = [0] * attachedFileCount
-
-        file.seek(ltb_start + attachedFileOffset)
-        for i in range(attachedFileCount):
-            self.attachedFileList[i] = struct.unpack("Q", file.read(0x8))[0]
-
-class LVBClass:
-    def __init__(self, lvb_file):
+        self.attachedFileList = self.array_table("Q", ltb_start + attachedFileOffset, attachedFileCount)
+
+    # Returns the contents of an attached file, decompressed if needed
+    def get_attached_file(self, index):
+        start = self.ltb_start + self.attachedFileList[index]
+        textureFormatInfo = self.textureFormatInfoList[index]
+        if textureFormatInfo.isCompressed != 0:
+            return WFLZ().decomp_buffer(self.buffer, start)[0]
+        return self.buffer[start:start + textureFormatInfo.size].tobytes()
+
+# Null terminated value strings keyed by their offset in the string section,
+# each string is only decoded the first time it's looked up
+class LVBStringTable(Mapping):
+    def __init__(self, data, start, size):
+        self.data = data
+        self.start = start
+        self.size = size
+        self.cache = { }
+
+    def is_string_start(self, offset):
+        if offset < 0 or offset >= self.size:
+            return False
+        return offset == 0 or self.data[self.start + offset - 1] == 0
+
+    def __getitem__(self, offset):
+        if offset in self.cache:
+            return self.cache[offset]
+        if not self.is_string_start(offset):
+            raise KeyError(offset)
+        pos = self.start + offset
+        end = self.data.find(b"\0", pos)
+        if end < 0:
+            end = len(self.data)
+        string = self.data[pos:end].decode("latin-1")
+        self.cache[offset] = string
+        return string
+    def __contains__(self, offset):
+        return offset in self.cache or self.is_string_start(offset)
+    def __iter__(self):
+        pos = 0
+        while pos < self.size:
+            yield pos
+            end = self.data.find(b"\0", self.start + pos)
+            if end < 0:
+                return
+            pos = end - self.start + 1
+    def __len__(self):
+        return sum(1 for offset in self)
+
+# Only the header is read when loading, every table is decoded the first time it's accessed
+class LVBClass(MappedFileClass):
+    def __init__(self, lvb_file, use_mmap = True):
         if lvb_file.suffix == '.lvb':
-            self.unpack(lvb_file)
+            self.unpack(lvb_file, use_mmap)
         else:
             _exit("Error: This is not a valid .LVB file!")
 
-    def unpack(self, ltb_file):
-        self.file = open(ltb_file, 'rb')
+    def unpack(self, lvb_file, use_mmap = True):
+        self.open_buffer(lvb_file, use_mmap)
 
-        file = self.file
         # path_hash = unpack(file, 4)
 
         self.lvb_start = lvb_start = 0x10
-        file.seek(lvb_start)
 
         # header = struct.unpack("IIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIIII", file.read(0x150))
-        header = struct.unpack("IIQIIQIIQIIQIIQIIQIIQ", file.read(0x70))
+        header = struct.unpack_from("IIQIIQIIQIIQIIQIIQIIQ", self.buffer, lvb_start)
 
         unk_Value_0x00 = header[0]
-        objectPropertyCountListCount = header[1]
-        objectPropertyCountListOffset = header[2]
-        objectInfoCount = header[3]
+        self.objectPropertyCountListCount = objectPropertyCountListCount = header[1]
+        self.objectPropertyCountListOffset = objectPropertyCountListOffset = header[2]
+        self.objectInfoCount = objectInfoCount = header[3]
         unk_Count_0x10 = header[4]
-        objectInfoListOffset = header[5]
+        self.objectInfoListOffset = objectInfoListOffset = header[5]
         unk_Value_0x20 = header[6]
-        rectangleBatchCount = header[7]
-        rectangleBatchOffset = header[8]
+        self.rectangleBatchCount = rectangleBatchCount = header[7]
+        self.rectangleBatchOffset = rectangleBatchOffset = header[8]
         unk_Value_0x30 = header[9]
-        rectListCount = header[10]
-        rectListOffset = header[11]
+        self.rectListCount = rectListCount = header[10]
+        self.rectListOffset = rectListOffset = header[11]
         unk_Value_0x40 = header[12]
-        propertyValueSetListCount = header[13]
-        propertyValueSetListOffset = header[14]
+        self.propertyValueSetListCount = propertyValueSetListCount = header[13]
+        self.propertyValueSetListOffset = propertyValueSetListOffset = header[14]
         unk_Value_0x50 = header[15]
-        unk_Count_0x50 = header[16]
-        unk_Offset_0x50 = header[17]
+        self.pathCount = unk_Count_0x50 = header[16]
+        self.pathListOffset = unk_Offset_0x50 = header[17]
         unk_Value_0x60 = header[18]
-        unk_Count_0x60 = header[19]
-        unk_Offset_0x60 = header[20]
+        self.stringListSize = unk_Count_0x60 = header[19]
+        self.stringListOffset = unk_Offset_0x60 = header[20]
 
         print("LayerObject Header:")
         print("-------------------")
@@ -895,57 +1442,55 @@ class LVBClass:
         print("String List Offset: 0x%X" % unk_Offset_0x60)
         print("")
 
-        ### Property Count Map
-        # Input:    ObjectID
-        # Output:   Property Count
-        self.objectPropertyCountMap = { }
-        file.seek(lvb_start + objectPropertyCountListOffset)
-        for i in range(objectPropertyCountListCount):
-            packed = struct.unpack("II", file.read(0x8))
-            self.objectPropertyCountMap[packed[0]] = packed[1]
-
-        ### Object Infos
         self.objectInfo = namedtuple("ObjectInfo", "unkHash layerNameHash x y scalex scaley isUnk6 objectID unk7 gID propertyCount propertyIndexStart unk11")
-        self.objectInfoList = [ None ] * objectInfoCount
-
-        file.seek(lvb_start + objectInfoListOffset)
-        for i in range(len(self.objectInfoList)):
-            self.objectInfoList[i] = self.objectInfo._make(struct.unpack("IIffffIHHIIII", file.read(0x30)))
-            object = self.objectInfoList[i]
-            # print("pos (%f %f) isUnk6 %X unk7 %X gID %X propertyCount %X propertyIndexStart %X unk11 %X" % (object.x, object.y, object.isUnk6, object.unk7, object.gID, object.propertyCount, object.propertyIndexStart, object.unk11))
-
-        ### Rectangle Batches
         self.rectangleBatch = namedtuple("RectangleBatch", "hash flag flag2 count start")
-        self.rectangleBatchList = [ None ] * rectangleBatchCount
-        file.seek(lvb_start + rectangleBatchOffset)
-        for i in range(rectangleBatchCount):
-            self.rectangleBatchList[i] = self.rectangleBatch._make(struct.unpack("IIIII", file.read(0x14)))
-
-        ### Rectangle Infos
         self.rectangleInfo = namedtuple("RectangleInfo", "x y width height isUnk id")
-        self.rectangleInfoList = [ None ] * rectListCount
-        file.seek(lvb_start + rectListOffset)
-        for i in range(rectListCount):
-            self.rectangleInfoList[i] = self.rectangleInfo._make(struct.unpack("IIIIIi", file.read(0x18)))
-
-        ### Unique Property Value Sets
         self.propertyValueSet = namedtuple("UniquePropertyValueSet", "hash stringOffset")
-        self.propertyValueSetList = [ None ] * propertyValueSetListCount
-        file.seek(lvb_start + propertyValueSetListOffset)
-        for i in range(propertyValueSetListCount):
-            self.propertyValueSetList[i] = self.propertyValueSet._make(struct.unpack("II", file.read(0x8)))
 
-        ### Paths
+    ### Property Count Map
+    # Input:    ObjectID
+    # Output:   Property Count
+    @cached_property
+    def objectPropertyCountMap(self):
+        start = self.lvb_start + self.objectPropertyCountListOffset
+        end = start + self.objectPropertyCountListCount * 0x8
+        return dict(struct.iter_unpack("II", self.buffer[start:end]))
+
+    ### Object Infos
+    @cached_property
+    def objectInfoList(self):
+        return self.unpack_table(self.objectInfo, "IIffffIHHIIII", self.lvb_start + self.objectInfoListOffset, self.objectInfoCount)
+
+    ### Rectangle Batches
+    @cached_property
+    def rectangleBatchList(self):
+        return self.unpack_table(self.rectangleBatch, "IIIII", self.lvb_start + self.rectangleBatchOffset, self.rectangleBatchCount)
+
+    ### Rectangle Infos
+    @cached_property
+    def rectangleInfoList(self):
+        return self.unpack_table(self.rectangleInfo, "IIIIIi", self.lvb_start + self.rectListOffset, self.rectListCount)
+
+    ### Unique Property Value Sets
+    @cached_property
+    def propertyValueSetList(self):
+        return self.unpack_table(self.propertyValueSet, "II", self.lvb_start + self.propertyValueSetListOffset, self.propertyValueSetListCount)
+
+    ### Paths
+    # The last path offset isn't a path
+    @cached_property
+    def pathList(self):
+        start = self.lvb_start + self.pathListOffset
+        paths = struct.unpack_from("%dQ" % self.pathCount, self.buffer, start)
+
+        pathList = [None] * max(len(paths) - 1, 0)
+        for i in range(len(pathList)):
+            pathList[i] = struct.unpack_from("I32sIfffIIIIIIIIIffffffffffffff", self.buffer, self.lvb_start + paths[i])
+        return pathList
+    def print_paths(self):
         print("Paths:")
         print("------")
-        paths = [0] * unk_Count_0x50
-        file.seek(lvb_start + unk_Offset_0x50)
-        for i in range(len(paths)):
-            paths[i] = struct.unpack("Q", file.read(0x8))[0]
-
-        for i in range(len(paths) - 1):
-            file.seek(lvb_start + paths[i])
-            object = struct.unpack("I32sIfffIIIIIIIIIffffffffffffff", file.read(0x90))
+        for object in self.pathList:
             print("%s" % (object[1].decode("utf8").split("\0", 1)[0]))
             print("0x%08X %f %f %f" % (object[0x2], object[0x3], object[0x4], object[0x5]))
             print("0x%08X 0x%08X 0x%08X 0x%08X" % (object[0x6], object[0x7], object[0x8], object[0x9]))
@@ -960,109 +1505,498 @@ class LVBClass:
         #     # print("0x%08X 0x%08X 0x%08X 0x%08X" % (object[0x18], object[0x19], object[0x1A], object[0x1B]))
         #     # print("0x%08X" % (object[0x1C]))
             print("")
-        # print("")
-
-        ### Value strings
-        self.valueStringListMap = { }
-        file.seek(lvb_start + unk_Offset_0x60)
-        start_pos = file.tell()
-        while file.tell() < start_pos + unk_Count_0x60:
-            pos = file.tell() - start_pos
-            self.valueStringListMap[pos] = ReadString(file)
-
-        return
-
-def LTBandLVBtoRSDKScene(ltb, lvb, folder):
-    wflz = WFLZ()
-    paletteFileIndex = 0
-    paletteColorCount = 0
-    paletteColorABGRtoIndexMap = { }
-    paletteColorIndexMaptoABGR = { }
-
-    tilesIndexedByteArr = [0] * (0x10 * 0x4000)
-    tilesCount = 0
 
-    srcTileMargin = 1
-    srcTilePadding = 2
-    srcTileSize = 16
-    srcTileCount = [ 0, 3, 401 ]
-    srcTileStart = [ 0, 0, 3 ] # this should be filled automatically
-
-    tilesSolidMap = { }
+    ### Value strings
+    @cached_property
+    def valueStringListMap(self):
+        return LVBStringTable(self.data, self.lvb_start + self.stringListOffset, self.stringListSize)
+
+LTB_CHUNK_SIZE = 16
+# Tiles are packed into the textures on an 18x18 grid, a 16x16 tile with a 1 pixel border
+LTB_TEXTURE_CELL_SIZE = 18
+
+# Per tile arrays for a layer's whole chunk grid, (chunkYCount * 16, chunkXCount * 16)
+# in row-major order. 'present' marks tiles of chunks that have tile data,
+# 'chunks' is the same per chunk, (chunkYCount, chunkXCount).
+LayerTiles = namedtuple("LayerTiles", "ids flipX flipY solid present chunks")
+
+def DecodeLayerTiles(ltb, layer):
+    chunkSize = LTB_CHUNK_SIZE
+    chunkXCount = layer.chunkXCount
+    chunkYCount = layer.chunkYCount
+    chunkCount = chunkXCount * chunkYCount
+
+    tileBuffer = np.frombuffer(ltb.tileBufferList, dtype=np.uint16)
+    chunkStarts = np.frombuffer(ltb.chunkInfoList.column("tileBufferStart"), dtype=np.uint32)
+    chunkStarts = chunkStarts[layer.chunkIDStart:layer.chunkIDStart + chunkCount].astype(np.int64)
+    chunks = chunkStarts > 0
+
+    # Gather every chunk's tiles at once, empty chunks read as 0
+    tileIndexes = chunkStarts[:, None] + np.arange(chunkSize * chunkSize)
+    tiledata = np.where(chunks[:, None], tileBuffer[np.where(chunks[:, None], tileIndexes, 0)], 0)
+
+    # (cy, cx, ty, tx) -> (cy, ty, cx, tx) -> rows and columns of tiles
+    tiledata = tiledata.reshape(chunkYCount, chunkXCount, chunkSize, chunkSize)
+    tiledata = tiledata.transpose(0, 2, 1, 3).reshape(chunkYCount * chunkSize, chunkXCount * chunkSize)
+    chunks = chunks.reshape(chunkYCount, chunkXCount)
+
+    return LayerTiles(
+        ids = tiledata & 0xFFF,
+        flipX = (tiledata & 0x2000) != 0,
+        flipY = (tiledata & 0x4000) != 0,
+        solid = (tiledata & 0x8000) != 0,
+        present = chunks.repeat(chunkSize, 0).repeat(chunkSize, 1),
+        chunks = chunks)
+
+# Tile grid built from the static vertex buffer quads, (height, width) in
+# row-major order and sized to fit every quad. 'tiles' holds the source cell
+# index + 1, 0 where there's no quad.
+StaticVertexTiles = namedtuple("StaticVertexTiles", "tiles flipX flipY")
+
+def TileizeStaticVertexBuffer(ltb, columncount, width = 0, height = 0):
+    vertexData = np.frombuffer(ltb.staticVertexDataArray, dtype=np.float32)
+    quadCount = len(vertexData) // 20
+    # Z formation, 4 vertices of x y z u v per quad
+    quads = vertexData[:quadCount * 20].reshape(quadCount, 4, 5).astype(np.float64)
+    x = quads[:, :, 0]
+    y = quads[:, :, 1]
+    u = quads[:, :, 3]
+    v = quads[:, :, 4]
+
+    # Compare UVs to determine orientation
+    flipX = u[:, 0] > u[:, 1]
+    flipY = v[:, 0] > v[:, 1]
+
+    meanX = (x[:, 0] + x[:, 1] + x[:, 2] + x[:, 3]) / 4
+    meanY = (y[:, 0] + y[:, 1] + y[:, 2] + y[:, 3]) / 4
+
+    tileX = np.floor((meanX / 0.1 + 240.0) / 16.0).astype(np.int64) # / 0.1, as this is undoes what game does internally
+    tileY = np.floor((meanY / 0.1 + 160.0) / 16.0).astype(np.int64) # / 0.1, as this is undoes what game does internally
+    cellX = np.floor(u[:, 0] * 512.0 / 18.0).astype(np.int64)
+    cellY = np.floor(v[:, 0] * 512.0 / 18.0).astype(np.int64)
+    tiles = cellX + cellY * columncount + 1
+
+    # Quads left of or above the origin can't be placed
+    placed = (tileX >= 0) & (tileY >= 0)
+    tileX = tileX[placed]
+    tileY = tileY[placed]
+
+    if len(tileX) > 0:
+        width = max(width, int(tileX.max()) + 1)
+        height = max(height, int(tileY.max()) + 1)
+
+    # Later quads overwrite earlier ones, keep the last quad for each tile
+    linear = (tileY * width + tileX)[::-1]
+    last = len(linear) - 1 - np.unique(linear, return_index=True)[1]
+    tileX = tileX[last]
+    tileY = tileY[last]
+
+    svbTiles = StaticVertexTiles(
+        tiles = np.zeros((height, width), dtype=np.int64),
+        flipX = np.zeros((height, width), dtype=bool),
+        flipY = np.zeros((height, width), dtype=bool))
+    svbTiles.tiles[tileY, tileX] = tiles[placed][last]
+    svbTiles.flipX[tileY, tileX] = flipX[placed][last]
+    svbTiles.flipY[tileY, tileX] = flipY[placed][last]
+    return svbTiles
+
+# Tileizes the static vertex buffer with room for every static vertex buffer layer
+def TileizeStaticVertexBufferForLayers(ltb, columncount):
+    width = 0
+    height = 0
+    for layer in ltb.layerInfoList:
+        if layer.isUsingStaticVertexBuffer != 0:
+            width = max(width, layer.endX - layer.startX + 1)
+            height = max(height, layer.endY + 1)
+    return TileizeStaticVertexBuffer(ltb, columncount, width, height)
+
+# Tile data encodings supported for Tiled output, mapped to Tiled's (encoding, compression) attributes
+TILED_DATA_ENCODINGS = {
+    "csv":    ("csv", None),
+    "base64": ("base64", None),
+    "zlib":   ("base64", "zlib"),
+    "gzip":   ("base64", "gzip"),
+    "zstd":   ("base64", "zstd"),
+}
+
+def TiledDataAttributes(encoding):
+    tiledEncoding, compression = TILED_DATA_ENCODINGS[encoding]
+    if compression == None:
+        return { "encoding": tiledEncoding }
+    return { "encoding": tiledEncoding, "compression": compression }
+
+# Encodes a grid of tile GIDs as the text of a Tiled <data>/<chunk> element (or a JSON "data" string)
+def EncodeTiledData(gids, encoding = "csv"):
+    if encoding == "csv":
+        return ",".join(map(str, gids.ravel().tolist()))
+
+    # Packed little-endian uint32 GIDs, row-major
+    data = np.ascontiguousarray(gids, dtype="<u4").tobytes()
+    compression = TILED_DATA_ENCODINGS[encoding][1]
+    if compression == "zlib":
+        data = zlib.compress(data, 9)
+    elif compression == "gzip":
+        data = gzip.compress(data, 9, mtime=0)
+    elif compression == "zstd":
+        if zstandard == None:
+            _exit("Error: zstd tile data encoding requires the 'zstandard' package.")
+        data = zstandard.ZstdCompressor(level=19).compress(data)
+    return base64.b64encode(data).decode("ascii")
+
+# Closes a writer's file and removes it, unless close() already put it in place
+def AbortTiledMapWriter(writer):
+    writer.file.close()
+    if os.path.isfile(writer.tempPath):
+        os.remove(writer.tempPath)
+
+# Tiled map writers. LTBandLVBtoTiled builds the map, layers and objects as dicts shaped like
+# Tiled's JSON format (with tile data left as GID grids), and each writer serializes them as they come in.
+# Writers fill a temporary file that close() moves into place, abort() drops it.
+class TMXMapWriter:
+    def __init__(self, path, tiledMap, encoding = "csv"):
+        self.path = path
+        self.tempPath = "%s.%d.tmp" % (path, os.getpid())
+        self.encoding = encoding
+        self.file = open(self.tempPath, "w", encoding="utf8")
+
+        xml_map = Element("map")
+        for key in ["version", "tiledversion", "orientation", "renderorder", "width", "height", "tilewidth", "tileheight"]:
+            xml_map.set(key, str(tiledMap[key]))
+        xml_map.set("infinite", "1" if tiledMap["infinite"] else "0")
+        self.writer = XMLStreamWriter(self.file, xml_map)
+        self.writer.write(Comment("Generated using ShovelKnightRE: https://github.com/aknetk/ShovelKnightRE"))
+
+    def write_properties(self, parent, properties):
+        xml_properties = SubElement(parent, "properties")
+        for property in properties:
+            xml_property = SubElement(xml_properties, "property")
+            xml_property.set("name", property["name"])
+            xml_property.set("type", property["type"])
+            if property["type"] == "float":
+                xml_property.set("value", "%f" % property["value"])
+            else:
+                xml_property.set("value", str(property["value"]))
+
+    def write_tileset(self, tileset):
+        xml_tileset = Element("tileset")
+        xml_tileset.set("firstgid", str(tileset["firstgid"]))
+        xml_tileset.set("source", tileset["source"])
+        self.writer.write(xml_tileset)
+
+    def write_layer(self, layer):
+        if layer["type"] == "tilelayer":
+            xml_layer = Element("layer")
+            for key in ["id", "name", "width", "height", "offsetx", "offsety"]:
+                xml_layer.set(key, str(layer[key]))
+            xml_layer.set("visible", "1" if layer["visible"] else "0")
+
+            xml_data = SubElement(xml_layer, "data")
+            for key, value in TiledDataAttributes(self.encoding).items():
+                xml_data.set(key, value)
+            self.write_properties(xml_layer, layer["properties"])
+
+            if "chunks" in layer:
+                for chunk in layer["chunks"]:
+                    xml_chunk = SubElement(xml_data, "chunk")
+                    for key in ["x", "y", "width", "height"]:
+                        xml_chunk.set(key, str(chunk[key]))
+                    xml_chunk.text = EncodeTiledData(chunk["data"], self.encoding)
+            else:
+                xml_data.text = EncodeTiledData(layer["data"], self.encoding)
+        else:
+            xml_layer = Element("objectgroup")
+            xml_layer.set("id", str(layer["id"]))
+            if not layer["visible"]:
+                xml_layer.set("visible", "false")
+            xml_layer.set("name", layer["name"])
+            for object in layer["objects"]:
+                xml_object = SubElement(xml_layer, "object")
+                for key in ["x", "y", "name", "width", "height", "id"]:
+                    if key in object:
+                        xml_object.set(key, str(object[key]))
+                if object.get("point", False):
+                    SubElement(xml_object, "point")
+                if "properties" in object:
+                    self.write_properties(xml_object, object["properties"])
+        self.writer.write(xml_layer)
+
+    def close(self, nextLayerID, nextObjectID):
+        self.writer.close()
+        self.file.close()
+        os.replace(self.tempPath, self.path)
+    def abort(self):
+        AbortTiledMapWriter(self)
+
+class TMJMapWriter:
+    def __init__(self, path, tiledMap, encoding = "csv"):
+        self.path = path
+        self.tempPath = "%s.%d.tmp" % (path, os.getpid())
+        self.encoding = encoding
+        self.file = open(self.tempPath, "w", encoding="utf8")
+        self.tiledMap = dict(tiledMap, type="map", tilesets=[])
+        self.layerCount = None
+
+    # The map header goes out with the first layer, once all tilesets are known
+    def write_header(self):
+        header = json.dumps(self.tiledMap)
+        self.file.write(header[:-1] + ', "layers": [')
+        self.layerCount = 0
+
+    def write_tileset(self, tileset):
+        self.tiledMap["tilesets"].append(dict(tileset))
+
+    # Tile data is a GID list for csv, otherwise the same base64 (compressed) string as in TMX
+    def encode_data(self, gids):
+        if self.encoding == "csv":
+            return gids.ravel().tolist()
+        return EncodeTiledData(gids, self.encoding)
+
+    def write_layer(self, layer):
+        if self.layerCount == None:
+            self.write_header()
+
+        layer = dict(layer, opacity=1, x=0, y=0)
+        if layer["type"] == "tilelayer":
+            layer.update(TiledDataAttributes(self.encoding))
+            if "chunks" in layer:
+                layer["chunks"] = [dict(chunk, data=self.encode_data(chunk["data"])) for chunk in layer["chunks"]]
+            else:
+                layer["data"] = self.encode_data(layer["data"])
+        else:
+            layer["draworder"] = "topdown"
+            layer["objects"] = [dict({ "name": "", "width": 0, "height": 0, "rotation": 0, "visible": True }, **object) for object in layer["objects"]]
+
+        if self.layerCount > 0:
+            self.file.write(", ")
+        json.dump(layer, self.file)
+        self.layerCount += 1
+
+    def close(self, nextLayerID, nextObjectID):
+        if self.layerCount == None:
+            self.write_header()
+        self.file.write('], "nextlayerid": %d, "nextobjectid": %d}\n' % (nextLayerID, nextObjectID))
+        self.file.close()
+        os.replace(self.tempPath, self.path)
+    def abort(self):
+        AbortTiledMapWriter(self)
+
+TILED_MAP_WRITERS = {
+    "tmx": TMXMapWriter,
+    "tmj": TMJMapWriter,
+}
+
+# A Tiled tileset for one of the LTB's textures
+TiledTileset = namedtuple("TiledTileset", "textureIndex firstgid columns tilecount source image")
+
+# Every texture a vertex buffer draws from becomes a tileset, 'firstgid's follow in texture order
+def GetTiledTilesets(ltb, stage_name):
+    tilesets = []
+    firstgid = 1
+    for textureIndex in sorted(set(info.textureIndex for info in ltb.vertexBufferInfoList)):
+        if textureIndex >= len(ltb.textureFormatInfoList):
+            continue
+        info = ltb.textureFormatInfoList[textureIndex]
+        columns = info.width // LTB_TEXTURE_CELL_SIZE
+        tilecount = columns * (info.height // LTB_TEXTURE_CELL_SIZE)
+        if tilecount == 0:
+            continue
+        source = stage_name + "_%d.tsx" % textureIndex
+        image = stage_name + "_%d.png" % textureIndex
+        tilesets.append(TiledTileset(textureIndex, firstgid, columns, tilecount, source, image))
+        firstgid += tilecount
+    return tilesets
+
+# Tileset of the texture a layer's vertex buffer uses, None if it has none
+def GetTiledLayerTileset(ltb, layer, tilesets):
+    if layer.vertexBufferInfoIndex >= len(ltb.vertexBufferInfoList):
+        return None
+    textureIndex = ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex
+    for tileset in tilesets:
+        if tileset.textureIndex == textureIndex:
+            return tileset
+    return None
+
+# GID offset for a layer's tile IDs, from the texture its vertex buffer uses
+def GetTiledLayerGIDOffset(ltb, layer, tilesets):
+    tileset = GetTiledLayerTileset(ltb, layer, tilesets)
+    if tileset == None:
+        return 0
+    return tileset.firstgid - 1
+
+def WriteTiledTileset(ltb, tileset, folder):
+    info = ltb.textureFormatInfoList[tileset.textureIndex]
+    xml_tileset = Element("tileset")
+    xml_tileset.set("version", "1.2")
+    xml_tileset.set("tiledversion", "1.3.3")
+    xml_tileset.set("name", Path(tileset.source).stem)
+    xml_tileset.set("tilewidth", str(ltb.tileSize))
+    xml_tileset.set("tileheight", str(ltb.tileSize))
+    xml_tileset.set("spacing", str(LTB_TEXTURE_CELL_SIZE - ltb.tileSize))
+    xml_tileset.set("margin", str((LTB_TEXTURE_CELL_SIZE - ltb.tileSize) // 2))
+    xml_tileset.set("tilecount", str(tileset.tilecount))
+    xml_tileset.set("columns", str(tileset.columns))
+    xml_image = SubElement(xml_tileset, "image")
+    xml_image.set("source", tileset.image)
+    xml_image.set("width", str(info.width))
+    xml_image.set("height", str(info.height))
+
+    ElementTree.indent(xml_tileset, "  ")
+    ElementTree.ElementTree(xml_tileset).write(folder + "/" + tileset.source, encoding="utf-8", xml_declaration=True)
+    return folder + "/" + tileset.source
+
+RSDK_PALETTE_SIZE = 256
+RSDK_PALETTE_TRANSPARENT = 0xFF00FF00
+
+# Maps every pixel of a 32-bit ABGR texture to a palette index. Colors missing from 'palette'
+# are added in order of first appearance, 'paletteIndexMap' is color -> index.
+def QuantizeABGRTexture(pixels, palette, paletteIndexMap):
+    colors, firstIndices, inverse = np.unique(pixels, return_index=True, return_inverse=True)
+    colorIndices = np.zeros(len(colors), dtype=np.int32)
+    newColors = []
+    for c, color in enumerate(colors.tolist()):
+        index = paletteIndexMap.get(color)
+        if index != None:
+            colorIndices[c] = index
+        else:
+            newColors.append(c)
+    for c in sorted(newColors, key=lambda c: firstIndices[c]):
+        color = int(colors[c])
+        colorIndices[c] = paletteIndexMap[color] = len(palette)
+        palette.append(color)
+    return colorIndices[inverse.ravel()]
+
+# Lookup table that sends every palette index past the RSDK palette's size to
+# the nearest (in RGBA) color within it, skipping the transparent index 0
+def GetPaletteReductionTable(palette):
+    channels = np.array(palette, dtype="<u4").view(np.uint8).reshape(-1, 4).astype(np.int32)
+    kept = channels[1:RSDK_PALETTE_SIZE]
+    overflow = channels[RSDK_PALETTE_SIZE:]
+    distances = ((overflow[:, None, :] - kept[None, :, :]) ** 2).sum(axis=2)
+    table = np.arange(len(palette), dtype=np.int32)
+    table[RSDK_PALETTE_SIZE:] = distances.argmin(axis=1) + 1
+    return table
+
+# Cuts a texture's 18x18 cells down to their 16x16 tiles, (rows * columns, 16, 16) in row-major order
+def SliceTextureCells(pixels):
+    margin = (LTB_TEXTURE_CELL_SIZE - 16) // 2
+    rows = pixels.shape[0] // LTB_TEXTURE_CELL_SIZE
+    columns = pixels.shape[1] // LTB_TEXTURE_CELL_SIZE
+    cells = pixels[:rows * LTB_TEXTURE_CELL_SIZE, :columns * LTB_TEXTURE_CELL_SIZE]
+    cells = cells.reshape(rows, LTB_TEXTURE_CELL_SIZE, columns, LTB_TEXTURE_CELL_SIZE).swapaxes(1, 2)
+    return cells[:, :, margin:margin + 16, margin:margin + 16].reshape(rows * columns, 16, 16)
+
+RSDK_TILE_COUNT = 0x400
+RSDK_TILE_FLIP_X = 0x400
+RSDK_TILE_FLIP_Y = 0x800
+
+# Collapses identical tiles, including ones that are flipped copies of each other.
+# Returns the unique tiles and, for every source tile, its unique tile index with the
+# RSDK flip bits needed to draw it from that tile.
+def DeduplicateTiles(tiles):
+    variantMap = { }
+    uniqueTiles = [ ]
+    tileRemap = [ ]
+    for tile in tiles:
+        match = variantMap.get(tile.tobytes())
+        if match != None:
+            tileRemap.append(match)
+            continue
 
-    parent_dir = Path(folder)
-    parent_dir.mkdir(exist_ok=True)
+        index = len(uniqueTiles)
+        uniqueTiles.append(tile)
+        # Tiles past RSDK_TILE_COUNT don't fit in the gif, their references wrap like
+        # the source indices used to instead of spilling into the flip bits
+        index &= RSDK_TILE_COUNT - 1
+        tileRemap.append(index)
+        variants = [
+            (tile, 0),
+            (tile[:, ::-1], RSDK_TILE_FLIP_X),
+            (tile[::-1, :], RSDK_TILE_FLIP_Y),
+            (tile[::-1, ::-1], RSDK_TILE_FLIP_X | RSDK_TILE_FLIP_Y),
+        ]
+        for variant, flip in variants:
+            variantMap.setdefault(variant.tobytes(), index | flip)
+    return np.array(uniqueTiles, dtype=tiles.dtype).reshape(-1, 16, 16), tileRemap
+
+# Sends source tile indices (srcTileStart based) through a tileset's remap, tile index and flip bits
+def RemapRSDKTiles(tiles, tileRemap):
+    inRange = (tiles >= 0) & (tiles < len(tileRemap))
+    return np.where(inRange, tileRemap[np.where(inRange, tiles, 0)], tiles & (RSDK_TILE_COUNT - 1))
+
+# Builds 16x16Tiles.gif from the LTB's textures, returns the palette as a list of ABGR colors and
+# the remap from source tiles to tiles in the gif (see DeduplicateTiles, the identity without 'dedupTiles').
+# With more than 256 colors, the extra colors are either reduced to their nearest palette color
+# or (without 'reduceColors') drawn with the transparent index.
+def BuildRSDKTileset(ltb, folder, paletteFileIndex, srcTileCount, reduceColors = True, dedupTiles = True):
+    palette = [ ]
+    paletteIndexMap = { }
+
+    sourceTiles = [ ]
 
     # Get starting palette
     if paletteFileIndex != -1:
-        textureFormatInfo = ltb.textureFormatInfoList[paletteFileIndex]
-        ltb.file.seek(ltb.ltb_start + ltb.attachedFileList[paletteFileIndex])
-        byteArr = ltb.file.read(textureFormatInfo.size)
-        for i in range(len(byteArr) >> 2):
-            i <<= 2
-            abgr = byteArr[i + 0] | byteArr[i + 1] << 8 | byteArr[i + 2] << 16 | byteArr[i + 3] << 24
-            i >>= 2
-
-            if abgr != 0xFF00FF00:
-                paletteColorABGRtoIndexMap[abgr] = paletteColorCount
-                paletteColorIndexMaptoABGR[paletteColorCount] = abgr
-                print("color[%d] = 0x%X" % (paletteColorCount, abgr))
-                paletteColorCount += 1
+        byteArr = ltb.get_attached_file(paletteFileIndex)
+        for abgr in np.frombuffer(byteArr, dtype="<u4", count=len(byteArr) >> 2).tolist():
+            if abgr != RSDK_PALETTE_TRANSPARENT:
+                paletteIndexMap[abgr] = len(palette)
+                print("color[%d] = 0x%X" % (len(palette), abgr))
+                palette.append(abgr)
 
     # Add used colors to the palette & add tiles
     for i in range(len(ltb.textureFormatInfoList)):
         if i != paletteFileIndex:
-            ltb.file.seek(ltb.ltb_start + ltb.attachedFileList[i])
-
             textureFormatInfo = ltb.textureFormatInfoList[i]
-            if textureFormatInfo.isCompressed != 0:
-                byteArr = wflz.decomp_file(ltb.file)
-            else:
-                byteArr = ltb.file.read(textureFormatInfo.size)
+            byteArr = ltb.get_attached_file(i)
 
             bpp = len(byteArr) / (textureFormatInfo.width * textureFormatInfo.height)
-            indexedByteArr = [0] * len(byteArr)
             if bpp == 4:
-                for p in range(len(byteArr) >> 2):
-                    p <<= 2
-                    abgr = byteArr[p + 0] | byteArr[p + 1] << 8 | byteArr[p + 2] << 16 | byteArr[p + 3] << 24
-                    p >>= 2
-
-                    if abgr in paletteColorABGRtoIndexMap.keys():
-                        indexedByteArr[p] = paletteColorABGRtoIndexMap[abgr]
-                    else:
-                        indexedByteArr[p] = paletteColorCount
-
-                        paletteColorABGRtoIndexMap[abgr] = paletteColorCount
-                        paletteColorIndexMaptoABGR[paletteColorCount] = abgr
-                        print("color[%d] = 0x%X" % (paletteColorCount, abgr))
-                        paletteColorCount += 1
+                paletteColorCount = len(palette)
+                indexedByteArr = QuantizeABGRTexture(np.frombuffer(byteArr, dtype="<u4"), palette, paletteIndexMap)
+                print("Texture %d: %d new colors (%d total)" % (i, len(palette) - paletteColorCount, len(palette)))
             else:
-                for p in range(len(byteArr)):
-                    indexedByteArr[p] = byteArr[p] >> 3
+                indexedByteArr = np.frombuffer(byteArr, dtype=np.uint8) >> 3
 
             t = srcTileCount[i]
             if t > 0:
-                srcTileCountW = int(textureFormatInfo.width / (srcTileSize + srcTilePadding))
-                for tp in range(int(t * 16 * 16)):
-                    srcInd = int(tp / 16 / 16)
-                    tp += int(tilesCount * 16 * 16)
-                    tpx = int(tp % 16)
-                    tpy = int(tp / 16)
-                    srcX = srcTileMargin + int(srcInd % srcTileCountW) * (srcTileSize + srcTilePadding) + tpx
-                    srcY = srcTileMargin + int(srcInd / srcTileCountW) * (srcTileSize + srcTilePadding) + (tpy % 16)
-                    tilesIndexedByteArr[tp] = indexedByteArr[srcX + srcY * textureFormatInfo.width]
-                tilesCount += t
+                cells = SliceTextureCells(indexedByteArr.reshape(textureFormatInfo.height, textureFormatInfo.width))[:t]
+                # Keep later textures lined up with srcTileStart even if this one is short
+                if len(cells) < t:
+                    cells = np.concatenate([cells, np.zeros((t - len(cells), 16, 16), dtype=cells.dtype)])
+                sourceTiles.append(cells.astype(np.int32))
+    sourceTiles = np.concatenate(sourceTiles) if len(sourceTiles) > 0 else np.zeros((0, 16, 16), dtype=np.int32)
+
+    # Fit the palette into 256 colors
+    if len(palette) > RSDK_PALETTE_SIZE:
+        if reduceColors:
+            print("Warning: The tileset uses %d colors, reducing to %d." % (len(palette), RSDK_PALETTE_SIZE))
+            reductionTable = GetPaletteReductionTable(palette)
+        else:
+            print("Warning: The tileset uses %d colors, only the first %d are kept." % (len(palette), RSDK_PALETTE_SIZE))
+            reductionTable = np.arange(len(palette), dtype=np.int32)
+            reductionTable[RSDK_PALETTE_SIZE:] = 0
+        sourceTiles = reductionTable[sourceTiles]
+        del palette[RSDK_PALETTE_SIZE:]
+
+    if dedupTiles:
+        tiles, tileRemap = DeduplicateTiles(sourceTiles)
+        print("Tiles: %d unique of %d" % (len(tiles), len(sourceTiles)))
+    else:
+        tiles, tileRemap = sourceTiles, [i & (RSDK_TILE_COUNT - 1) for i in range(len(sourceTiles))]
+    if len(tiles) > RSDK_TILE_COUNT:
+        print("Warning: The tileset has %d tiles, 16x16Tiles.gif only holds %d." % (len(tiles), RSDK_TILE_COUNT))
+        tiles = tiles[:RSDK_TILE_COUNT]
+
+    # One 16 pixel wide column of tiles, 0x400 tiles tall
+    tilesIndexedByteArr = np.zeros((RSDK_TILE_COUNT * 16, 16), dtype=np.int32)
+    tilesIndexedByteArr[:len(tiles) * 16] = tiles.reshape(-1, 16)
 
     # Add padding to palette
-    for c in range(paletteColorCount, 256):
-        paletteColorIndexMaptoABGR[paletteColorCount] = 0xFF7F00FF
-        paletteColorCount += 1
+    palette += [0xFF7F00FF] * (RSDK_PALETTE_SIZE - len(palette))
 
     # Turn into paletteData
     paletteData = [0] * 0x300
-    for c in range(paletteColorCount):
-        ABGR = paletteColorIndexMaptoABGR[c]
+    for c in range(len(palette)):
+        ABGR = palette[c]
         paletteData[c * 3 + 0] = (ABGR) & 0xFF
         paletteData[c * 3 + 1] = (ABGR >> 8) & 0xFF
         paletteData[c * 3 + 2] = (ABGR >> 16) & 0xFF
@@ -1073,73 +2007,169 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
     paletteData[2] = 0xFF
 
     # Output 16x16Tiles.gif
-    image = Image.new("P", (0x10, 0x4000))
+    image = Image.frombytes("P", (0x10, 0x4000), tilesIndexedByteArr.astype(np.uint8).tobytes())
     image.putpalette(paletteData)
-    image.putdata(tilesIndexedByteArr)
     image.save(folder + "/" + "16x16Tiles.gif")
 
+    return palette, tileRemap
+
+RSDK_LAYER_COUNT = 8
+# Layer name suffixes for variants that share their base layer's RSDK layer
+RSDK_LAYER_VARIANT_SUFFIXES = [ "_SHOVEL", "_FORWATER" ]
+# Layers of the other campaigns aren't converted
+RSDK_LAYER_SKIP_SUFFIXES = [ "_PLAGUE", "_SPECTER", "_KING" ]
+# Layers drawn into another layer's RSDK layer
+RSDK_LAYER_MERGES = { "LADDER": "PF" }
+
+# Where each texture's tiles start in 16x16Tiles.gif, they're packed in texture order
+def GetRSDKSourceTileStarts(srcTileCount):
+    srcTileStart = [0] * len(srcTileCount)
+    for i in range(1, len(srcTileCount)):
+        srcTileStart[i] = srcTileStart[i - 1] + srcTileCount[i - 1]
+    return srcTileStart
+
+# Everything LTBandLVBtoRSDKScene needs to know about a stage's textures and layers:
+# paletteFileIndex: texture holding the palette, -1 if none
+# srcTileCount / srcTileStart: tiles used from each texture, and where they start in 16x16Tiles.gif
+# columncount: tile columns in the static vertex buffer's texture
+# outputLayerMap: LTB layer name -> RSDK scene layer index
+# reduceColors: whether colors past the 256 color palette are reduced to their nearest palette color
+# dedupTiles: whether identical (or flipped) tiles share one tile in 16x16Tiles.gif
+RSDKStageProfile = namedtuple("RSDKStageProfile", "paletteFileIndex srcTileCount srcTileStart columncount outputLayerMap reduceColors dedupTiles")
+
+def GetLTBLayerName(layer):
+    return layer.name.decode("utf8").split('\0', 1)[0]
+
+def GetLTBLayerTextureIndex(ltb, layer):
+    if layer.vertexBufferInfoIndex >= len(ltb.vertexBufferInfoList):
+        return -1
+    return ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex
+
+# Works out the stage profile from the LTB, then applies any overrides from the
+# optional profile file (JSON with any of RSDKStageProfile's fields), by default <stage>.rsdk.json next to the LTB
+def GetRSDKStageProfile(ltb, profilePath = None):
+    layers = [layer for layer in ltb.layerInfoList if layer.endX - layer.startX >= -1 and layer.endY - layer.startY >= -1]
+    usedTextures = set(GetLTBLayerTextureIndex(ltb, layer) for layer in layers)
+
+    # The palette is a small raw 32-bit texture no layer draws from
+    paletteFileIndex = -1
+    for i in range(len(ltb.textureFormatInfoList)):
+        info = ltb.textureFormatInfoList[i]
+        if not i in usedTextures and info.isCompressed == 0 and info.width * info.height <= 256 and info.width * info.height * 4 == info.size:
+            paletteFileIndex = i
+            break
+
+    columncount = 28
+    for layer in layers:
+        textureIndex = GetLTBLayerTextureIndex(ltb, layer)
+        if layer.isUsingStaticVertexBuffer != 0 and 0 <= textureIndex < len(ltb.textureFormatInfoList):
+            columncount = ltb.textureFormatInfoList[textureIndex].width // LTB_TEXTURE_CELL_SIZE
+            break
+
+    # Each texture contributes tiles up to the highest tile ID any layer uses from it
+    svbTiles = TileizeStaticVertexBufferForLayers(ltb, columncount)
+    srcTileCount = [0] * len(ltb.textureFormatInfoList)
+    for layer in layers:
+        textureIndex = GetLTBLayerTextureIndex(ltb, layer)
+        if not 0 <= textureIndex < len(srcTileCount) or textureIndex == paletteFileIndex:
+            continue
+        if layer.isUsingStaticVertexBuffer != 0:
+            tileIDs = svbTiles.tiles[layer.startY:layer.endY + 1, :layer.endX - layer.startX + 1]
+        else:
+            layerTiles = DecodeLayerTiles(ltb, layer)
+            tileIDs = layerTiles.ids[layerTiles.present]
+        if tileIDs.size > 0:
+            srcTileCount[textureIndex] = max(srcTileCount[textureIndex], int(tileIDs.max()))
+    srcTileStart = GetRSDKSourceTileStarts(srcTileCount)
+
+    # One scene layer per base layer name, in LTB order
+    outputLayerMap = { }
+    baseLayerIndices = { }
+    for layer in layers:
+        layerName = GetLTBLayerName(layer)
+        if any(layerName.endswith(suffix) for suffix in RSDK_LAYER_SKIP_SUFFIXES):
+            continue
+        baseName = layerName
+        for suffix in RSDK_LAYER_VARIANT_SUFFIXES:
+            if baseName.endswith(suffix):
+                baseName = baseName[:-len(suffix)]
+        baseName = RSDK_LAYER_MERGES.get(baseName, baseName)
+        if not baseName in baseLayerIndices:
+            if len(baseLayerIndices) == RSDK_LAYER_COUNT:
+                print("Warning: No room for layer '%s', RSDK scenes only have %d layers." % (layerName, RSDK_LAYER_COUNT))
+                continue
+            baseLayerIndices[baseName] = len(baseLayerIndices)
+        outputLayerMap[layerName] = baseLayerIndices[baseName]
+
+    profile = RSDKStageProfile(paletteFileIndex, srcTileCount, srcTileStart, columncount, outputLayerMap, True, True)
+
+    if profilePath == None:
+        profilePath = ltb.path.with_suffix(".rsdk.json")
+    if Path(profilePath).is_file():
+        with open(profilePath, "r") as file:
+            overrides = json.load(file)
+        for key in overrides.keys():
+            if not key in RSDKStageProfile._fields:
+                raise ValueError("Unknown stage profile field '%s' in '%s'" % (key, profilePath))
+        profile = profile._replace(**overrides)
+        # Keep the tiles lined up with overridden counts
+        if not "srcTileStart" in overrides:
+            profile = profile._replace(srcTileStart=GetRSDKSourceTileStarts(profile.srcTileCount))
+        print("Loaded stage profile '%s'" % (profilePath))
+    return profile
+
+# Content hash of a stage profile, for the build cache keys
+def GetRSDKStageProfileHash(profile):
+    return hashlib.blake2b(json.dumps(profile._asdict(), sort_keys=True).encode("utf8"), digest_size=16).hexdigest()
+
+# With a BuildCache the whole stage is skipped when neither file changed,
+# and the tileset is reused when only the LVB changed.
+# 'profile' is worked out from the LTB (and the stage's profile file) when not given.
+def LTBandLVBtoRSDKScene(ltb, lvb, folder, cache = None, profile = None):
+    if profile == None:
+        profile = GetRSDKStageProfile(ltb)
+    paletteFileIndex = profile.paletteFileIndex
+    srcTileCount = profile.srcTileCount
+    srcTileStart = profile.srcTileStart
+    outputLayerMap = profile.outputLayerMap
+
+    tilesSolidMap = { }
+
+    outputs = [folder + "/" + name for name in ["16x16Tiles.gif", "Scene1.bin", "StageConfig.bin", "TileConfig.bin"]]
+    profileHash = GetRSDKStageProfileHash(profile)
+    tilesetKey = ltb.get_hash() + profileHash
+    stageKey = ltb.get_hash() + lvb.get_hash() + profileHash
+    if cache != None and cache.is_current("rsdk", stageKey):
+        print("RSDK scene is up to date")
+        return
+
+    parent_dir = Path(folder)
+    parent_dir.mkdir(exist_ok=True)
+
+    # The tile remap has to stay with the tileset it was made for
+    if cache != None and cache.is_current("rsdk_tileset", tilesetKey):
+        print("RSDK tileset is up to date")
+        paletteColors, tileRemap = cache.get("rsdk_tileset")
+    else:
+        paletteColors, tileRemap = BuildRSDKTileset(ltb, folder, paletteFileIndex, srcTileCount, profile.reduceColors, profile.dedupTiles)
+        if cache != None:
+            cache.set("rsdk_tileset", tilesetKey, [paletteColors, tileRemap], outputs[:1])
+    paletteColorCount = len(paletteColors)
+    tileRemap = np.array(tileRemap, dtype=np.int32)
+
     # Create Scene1.bin
-    outputLayerMap = {
-        "BG": 0,
-        "MG3": 1,
-        "MG2": 2,
-        "MG1.5": 3,
-        "MG1_TREES": 4,
-        "BGWATERFALL": 5,
-        "PF_BG_FORWATER": 6,
-        "PF_BG": 6,
-        "LADDER": 7,
-        "LADDER_SHOVEL": 7,
-        "PF": 7,
-        "PF_SHOVEL": 7,
-    }
-    layerSizes = [
-        [0, 0],
-        [0, 0],
-        [0, 0],
-        [0, 0],
-        [0, 0],
-        [0, 0],
-        [0, 0],
-        [0, 0],
-    ]
+    layerSizes = [[0, 0] for i in range(RSDK_LAYER_COUNT)]
 
     # Tileize static vertex buffer
-    columncount = 28
-    tileBufferSVB = [[0] * 32 for i in range(32)]
-    for i in range(len(ltb.staticVertexDataList) >> 2):
-        # Z formation
-        v1 = ltb.staticVertexDataList[i * 4 + 0]
-        v2 = ltb.staticVertexDataList[i * 4 + 1]
-        v3 = ltb.staticVertexDataList[i * 4 + 2]
-        v4 = ltb.staticVertexDataList[i * 4 + 3]
-
-        # Compare UVs to determine orientation
-        flip_x = v1[3] > v2[3]
-        flip_y = v1[4] > v2[4]
-
-        mean_x = (v1[0] + v2[0] + v3[0] + v4[0]) / 4
-        mean_y = (v1[1] + v2[1] + v3[1] + v4[1]) / 4
-
-        x = mean_x / 0.1 + 240.0 # / 0.1, as this is undoes what game does internally
-        y = mean_y / 0.1 + 160.0 # / 0.1, as this is undoes what game does internally
-        z = v1[2]
-        u = v1[3] * 512.0
-        v = v1[4] * 512.0
-
-        tile_x = math.floor(x / 16.0)
-        tile_y = math.floor(y / 16.0)
-        cell_x = math.floor(u / 18.0)
-        cell_y = math.floor(v / 18.0)
-        tileBufferSVB[tile_x][tile_y] = math.floor(cell_x + cell_y * columncount) + 1
+    svbTiles = TileizeStaticVertexBufferForLayers(ltb, profile.columncount)
 
     scene = RSDK_Scene()
 
     # Get max sizes for each layer
     for i in range(len(ltb.layerInfoList)):
         layer = ltb.layerInfoList[i]
-        layerName = layer.name.decode("utf8").split('\0', 1)[0]
-        if "_PLAGUE" in layerName:
+        layerName = GetLTBLayerName(layer)
+        if not layerName in outputLayerMap.keys():
             continue
         if layer.endX - layer.startX < -1:
             continue
@@ -1156,7 +2186,7 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
             layerSizes[targetLayerIndex][1] = endY
 
     # Set layers and sizes
-    for i in range(8):
+    for i in range(RSDK_LAYER_COUNT):
         if layerSizes[i][0] > 0 and layerSizes[i][1] > 0:
             sceneLayer = RSDK_SceneLayer(layerSizes[i][0], layerSizes[i][1])
             scene.Layers.append(sceneLayer)
@@ -1164,7 +2194,7 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
     # Write layers to scene
     for i in range(len(ltb.layerInfoList)):
         layer = ltb.layerInfoList[i]
-        layerName = layer.name.decode("utf8").split('\0', 1)[0]
+        layerName = GetLTBLayerName(layer)
         if not layerName in outputLayerMap.keys():
             continue
         if layer.endX - layer.startX < -1:
@@ -1178,48 +2208,36 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
         sceneLayer.ScrollingInfo[0].RelativeSpeed = int(layer.cameraMultX * 0x100)
 
         if layer.isUsingStaticVertexBuffer != 0:
-            for ty in range(layer.endY - layer.startY + 1):
-                for tx in range(layer.endX - layer.startX + 1):
-                    tile = int(tileBufferSVB[tx][layer.endY - ty])
-                    if tile != 0:
-                        tile += srcTileStart[ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex]
-                        sceneLayer.Tiles[layer.startX + tx][layer.startY + ty] = tile - 1
+            # Rows are stored bottom-up
+            tile = svbTiles.tiles[layer.startY:layer.endY + 1][::-1, :layer.endX - layer.startX + 1]
+            mask = tile != 0
+            tile = RemapRSDKTiles(tile + srcTileStart[ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex] - 1, tileRemap)
+
+            target = sceneLayer.Tiles[layer.startY:layer.startY + tile.shape[0], layer.startX:layer.startX + tile.shape[1]]
+            target[mask] = tile[mask]
         else:
-            chunkStart = layer.chunkIDStart
-            for cy in range(layer.chunkYCount):
-                for cx in range(layer.chunkXCount):
-                    chunkID = chunkStart + cx + cy * layer.chunkXCount
-                    tileStart = ltb.chunkInfoList[chunkID].tileBufferStart
-                    if tileStart > 0:
-                        for ty in range(16):
-                            for tx in range(16):
-                                tiledata = ltb.tileBufferList[tileStart + tx + ty * 16]
-                                isSolid = tiledata & 0x8000
-                                flip_x = tiledata & 0x2000
-                                flip_y = tiledata & 0x4000
-                                tile_id = tiledata & 0xFFF
-
-                                if layer.startX + cx * 16 + tx <= layer.endX and layer.startY + cy * 16 + ty <= layer.endY:
-                                    tiled_out = tile_id
-
-                                    if tile_id != 0:
-                                        tiled_out += srcTileStart[ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex]
-                                        tiled_out -= 1
-
-                                        tiled_out &= 0x3FF
-
-                                        if isSolid != 0:
-                                            if not tiled_out in tilesSolidMap.keys():
-                                                tilesSolidMap[tiled_out] = True
-
-                                        if flip_x != 0:
-                                            tiled_out |= 0x400
-                                        if flip_y != 0:
-                                            tiled_out |= 0x800
-                                        if isSolid != 0:
-                                            tiled_out |= 0xF000
-
-                                        sceneLayer.Tiles[layer.startX + cx * 16 + tx][layer.startY + cy * 16 + ty] = tiled_out
+            layerTiles = DecodeLayerTiles(ltb, layer)
+
+            # Crop to the layer's bounds
+            height = min(layer.endY - layer.startY + 1, layerTiles.ids.shape[0])
+            width = min(layer.endX - layer.startX + 1, layerTiles.ids.shape[1])
+            tile_id = layerTiles.ids[:height, :width].astype(np.int32)
+            isSolid = layerTiles.solid[:height, :width]
+            mask = layerTiles.present[:height, :width] & (tile_id != 0)
+
+            tiled_out = tile_id + srcTileStart[ltb.vertexBufferInfoList[layer.vertexBufferInfoIndex].textureIndex] - 1
+            tiled_out = RemapRSDKTiles(tiled_out, tileRemap)
+
+            for tile in np.unique(tiled_out[mask & isSolid] & (RSDK_TILE_COUNT - 1)).tolist():
+                tilesSolidMap[tile] = True
+
+            # A flipped reference to a deduplicated tile that's itself flipped cancels out
+            tiled_out ^= layerTiles.flipX[:height, :width] * RSDK_TILE_FLIP_X
+            tiled_out ^= layerTiles.flipY[:height, :width] * RSDK_TILE_FLIP_Y
+            tiled_out |= isSolid * 0xF000
+
+            target = sceneLayer.Tiles[layer.startY:layer.startY + height, layer.startX:layer.startX + width]
+            target[mask] = tiled_out[mask]
 
     # Write objects to scene
     objectNameDict = {
@@ -1264,11 +2282,11 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
                 scnClass = scene.GetClass(oName)
                 scnClass.AddProperty(0, "SubObjectID")
 
-            entity = scnClass.AddEntity(int(object.x * 0x10000), int(object.y * 0x10000))
-            entity.Values[1] = subObjectID
+            scnClass.AddEntity(int(object.x * 0x10000), int(object.y * 0x10000), subObjectID)
 
     scene.AutoAdjustSlotIDs()
-    scene.Write(open(folder + "/" + "Scene1.bin", "wb"))
+    with open(folder + "/" + "Scene1.bin", "wb") as file:
+        scene.Write(file)
 
     # Create StageConfig
     stageConfig = RSDK_StageConfig()
@@ -1280,10 +2298,11 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
 
     # Copy over palette
     for i in range(paletteColorCount):
-        stageConfig.Palettes[0].Colors[int(i / 16)][int(i % 16)].RGB = paletteColorIndexMaptoABGR[i] & 0xFFFFFF
+        stageConfig.Palettes[0].Colors[int(i / 16)][int(i % 16)].RGB = paletteColors[i] & 0xFFFFFF
 
     # Write StageConfig
-    stageConfig.Write(open(folder + "/" + "StageConfig.bin", "wb"))
+    with open(folder + "/" + "StageConfig.bin", "wb") as file:
+        stageConfig.Write(file)
 
     # Create TileConfig
     tileConfig = RSDK_TileConfig()
@@ -1294,10 +2313,31 @@ def LTBandLVBtoRSDKScene(ltb, lvb, folder):
         tileConfig.CollisionPath2[i].HasCollision = bytearray([1] * 16)
 
     # Write TileConfig
-    tileConfig.Write(open(folder + "/" + "TileConfig.bin", "wb"))
+    with open(folder + "/" + "TileConfig.bin", "wb") as file:
+        tileConfig.Write(file)
+
+    if cache != None:
+        cache.set("rsdk", stageKey, None, outputs)
+        cache.save()
+
+    # Saved last, the stage is complete even if the name cache can't be written
+    nameDatabase = GetRSDKNameDatabase()
+    nameDatabase.add_names(objectNameDict.values())
+    if nameDatabase.changed:
+        SaveNameDatabase(nameDatabase)
     return
 
-def LTBandLVBtoTiled(ltb, lvb):
+# With a BuildCache the whole stage is skipped when neither file changed,
+# and the textures aren't written again when only the LVB changed.
+# The map, its tilesets and textures all go to 'folder', named after 'stage_name' (the LTB's name by default).
+def LTBandLVBtoTiled(ltb, lvb, folder = None, cache = None, encoding = "csv", formats = ("tmx",), stage_name = None):
+    if folder == None:
+        folder = "../Scenes"
+    if stage_name == None:
+        stage_name = ltb.path.stem
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    map_paths = { format: folder + "/" + stage_name + "." + format for format in formats }
+
     # Player pos 90.4 -468.99
 
     objectNameDict = {
@@ -1328,7 +2368,6 @@ def LTBandLVBtoTiled(ltb, lvb):
         196: "PlagueCoin",
         215: "PlagueUnknown1"
     }
-    parameterMap = { }
     parameterList = [
         "COLLISION0",
         "COLLISION1",
@@ -2318,10 +3357,17 @@ def LTBandLVBtoTiled(ltb, lvb):
         "startOut",
         "tombShow",
     ]
-    for i in range(len(parameterList)):
-        stri = parameterList[i]
-        hash = YCG_Hash(stri, len(stri), 123456789)
-        parameterMap[hash] = stri
+    nameDatabase = YCGNameDatabase()
+    addedNames = nameDatabase.add_names(parameterList)
+    parameterMap = nameDatabase.names
+
+    # Names resolved since the last run (e.g. by --crack) change the map too
+    stageKey = ltb.get_hash() + lvb.get_hash() + nameDatabase.get_hash() + stage_name + encoding + ",".join(formats)
+    if cache != None and cache.is_current("tiled", stageKey):
+        print("Tiled map is up to date")
+        if addedNames > 0:
+            SaveNameDatabase(nameDatabase)
+        return
 
     # print("Unique Property Value Sets:")
     # print("---------------------------")
@@ -2338,258 +3384,431 @@ def LTBandLVBtoTiled(ltb, lvb):
     # print("Discovered %d / %d" % (discovered, discoveredMax))
     # print("")
 
-    map_name = "Plains"
-
     layer_id = 1
     object_id = 1
 
-    xml_map = Element("map")
-    xml_map.set("version", "1.2")
-    xml_map.set("tiledversion", "1.3.3")
-    xml_map.set("orientation", "orthogonal")
-    xml_map.set("renderorder", "right-down")
-    xml_map.set("width", "25")
-    xml_map.set("height", "25")
-    xml_map.set("tilewidth", "16")
-    xml_map.set("tileheight", "16")
-    xml_map.set("infinite", "0")
-    # xml_map.set("nextlayerid", "3")
-    # xml_map.set("nextobjectid", "2")
-
-    comment = Comment("Generated using ShovelKnightRE: https://github.com/aknetk/ShovelKnightRE")
-    xml_map.append(comment)
-
-    xml_tileset = SubElement(xml_map, "tileset")
-    xml_tileset.set("firstgid", "1")
-    xml_tileset.set("source", "Plains.tsx")
-    xml_tileset = SubElement(xml_map, "tileset")
-    xml_tileset.set("firstgid", "785")
-    xml_tileset.set("source", "PlainsWaterfall.tsx")
-
-    tilebuffer = [[0] * 64 for i in range(64)]
-
-    columncount = 28
-    for i in range(len(ltb.staticVertexDataList) >> 2):
-        # Z formation
-        v1 = ltb.staticVertexDataList[i * 4 + 0]
-        v2 = ltb.staticVertexDataList[i * 4 + 1]
-        v3 = ltb.staticVertexDataList[i * 4 + 2]
-        v4 = ltb.staticVertexDataList[i * 4 + 3]
-
-        # Compare UVs to determine orientation
-        flip_x = v1[3] > v2[3]
-        flip_y = v1[4] > v2[4]
-
-        mean_x = (v1[0] + v2[0] + v3[0] + v4[0]) / 4
-        mean_y = (v1[1] + v2[1] + v3[1] + v4[1]) / 4
-
-        x = mean_x / 0.1 + 240.0 # / 0.1, as this is undoes what game does internally
-        y = mean_y / 0.1 + 160.0 # / 0.1, as this is undoes what game does internally
-        z = v1[2]
-        u = v1[3] * 512.0
-        v = v1[4] * 512.0
-
-        tile_x = math.floor(x / 16.0)
-        tile_y = math.floor(y / 16.0)
-        cell_x = math.floor(u / 18.0)
-        cell_y = math.floor(v / 18.0)
-        tilebuffer[tile_x][tile_y] = math.floor(cell_x + cell_y * columncount) + 1
-
-    normal_tile_count = 401
-    first_sheet_tile_count = 784
-
-    layerList_string = ""
-    for i in range(len(ltb.layerInfoList)):
-        layer = ltb.layerInfoList[i]
-        visible = 1
-        if layer.endX - layer.startX < -1:
-            continue
-        if layer.endY - layer.startY < -1:
-            continue
-
-        xml_layer = SubElement(xml_map, "layer")
-        xml_layer.set("id", str(layer_id))
-        xml_layer.set("name", layer.name.decode("utf8").split('\0', 1)[0])
-        xml_layer.set("width", str(layer.endX - layer.startX + 1))
-        xml_layer.set("height", str(layer.endY - layer.startY + 1))
-        xml_layer.set("offsetx", str(layer.startX * 16))
-        xml_layer.set("offsety", str(layer.startY * 16))
-        xml_layer.set("visible", str(visible))
-        layer_id += 1
-
-        xml_data = SubElement(xml_layer, "data")
-        xml_data.set("encoding", "csv")
-
-        xml_properties = SubElement(xml_layer, "properties")
-        xml_property = SubElement(xml_properties, "property")
-        xml_property.set("name", "SCROLL_X_MULT")
-        xml_property.set("type", "float")
-        xml_property.set("value", "%f" % layer.cameraMultX)
-        xml_property = SubElement(xml_properties, "property")
-        xml_property.set("name", "SCROLL_Y_MULT")
-        xml_property.set("type", "float")
-        xml_property.set("value", "%f" % layer.cameraMultY)
-
-        if layer.isUsingStaticVertexBuffer != 0:
-            csv = ""
-            first = True
-            for ty in range(layer.endY - layer.startY + 1):
-                for tx in range(layer.endX - layer.startX + 1):
-                    if first:
-                        csv += "%d" % (int(tilebuffer[tx][layer.endY - ty]))
-                        first = False
-                    else:
-                        csv += ",%d" % (int(tilebuffer[tx][layer.endY - ty]))
-            xml_layer.set("offsetx", "0.0")
-            xml_layer.set("offsety", "0.0")
-            xml_data.text = csv
-        else:
-            chunk_text = ""
-            chunkStart = layer.chunkIDStart
-            for cy in range(layer.chunkYCount):
-                for cx in range(layer.chunkXCount):
-                    chunkID = chunkStart + cx + cy * layer.chunkXCount
-                    tileStart = ltb.chunkInfoList[chunkID].tileBufferStart
-                    if tileStart > 0:
-                        csv = ""
-                        first = True
-                        for ty in range(16):
-                            for tx in range(16):
-                                tiledata = ltb.tileBufferList[tileStart + tx + ty * 16]
-                                isSolid = tiledata & 0x8000
-                                flip_x = tiledata & 0x2000
-                                flip_y = tiledata & 0x4000
-                                tile_id = tiledata & 0xFFF
-                                tiled_out = tile_id
-
-                                if "BGWATERFALL" in layer.name.decode():
-                                    tiled_out += first_sheet_tile_count
-
-                                if tiled_out != 0:
-                                    if flip_x != 0:
-                                        tiled_out |= 0x80000000
-                                    if flip_y != 0:
-                                        tiled_out |= 0x40000000
-                                if first:
-                                    csv += "%d" % (int(tiled_out))
-                                    first = False
-                                else:
-                                    csv += ",%d" % (int(tiled_out))
-
-                        xml_chunk = SubElement(xml_data, "chunk")
-                        xml_chunk.set("x", str(cx * 16))
-                        xml_chunk.set("y", str(cy * 16))
-                        xml_chunk.set("width", "16")
-                        xml_chunk.set("height", "16")
-                        xml_chunk.text = csv
-
-    for b in range(len(lvb.rectangleBatchList)):
-        batch = lvb.rectangleBatchList[b]
-        xml_objectgroup = SubElement(xml_map, "objectgroup")
-        xml_objectgroup.set("id", str(layer_id))
-        xml_objectgroup.set("visible", "false")
-        if batch.hash in parameterMap.keys():
-            print(parameterMap[batch.hash])
-            xml_objectgroup.set("name", parameterMap[batch.hash])
-        else:
-            xml_objectgroup.set("name", "Rect Layer %08X" % batch.hash)
+    tiledMap = {
+        "version": "1.2",
+        "tiledversion": "1.3.3",
+        "orientation": "orthogonal",
+        "renderorder": "right-down",
+        "width": 25,
+        "height": 25,
+        "tilewidth": 16,
+        "tileheight": 16,
+        "infinite": False,
+    }
+    # Maps go to temporary files that replace the real ones once complete
+    writers = []
+    try:
+        for format in formats:
+            writers.append(TILED_MAP_WRITERS[format](map_paths[format], tiledMap, encoding))
+
+        tilesets = GetTiledTilesets(ltb, stage_name)
+        for writer in writers:
+            for tileset in tilesets:
+                writer.write_tileset({ "firstgid": tileset.firstgid, "source": tileset.source })
+
+        # Static vertex buffer tile IDs count cells in the texture of the layers using it
+        columncount = 28
+        for layer in ltb.layerInfoList:
+            tileset = GetTiledLayerTileset(ltb, layer, tilesets)
+            if layer.isUsingStaticVertexBuffer != 0 and tileset != None:
+                columncount = tileset.columns
+                break
+        svbTiles = TileizeStaticVertexBufferForLayers(ltb, columncount)
+
+        for i in range(len(ltb.layerInfoList)):
+            layer = ltb.layerInfoList[i]
+            visible = 1
+            if layer.endX - layer.startX < -1:
+                continue
+            if layer.endY - layer.startY < -1:
+                continue
+
+            tiledLayer = {
+                "type": "tilelayer",
+                "id": layer_id,
+                "name": layer.name.decode("utf8").split('\0', 1)[0],
+                "width": layer.endX - layer.startX + 1,
+                "height": layer.endY - layer.startY + 1,
+                "offsetx": layer.startX * 16,
+                "offsety": layer.startY * 16,
+                "visible": visible != 0,
+                "properties": [
+                    { "name": "SCROLL_X_MULT", "type": "float", "value": layer.cameraMultX },
+                    { "name": "SCROLL_Y_MULT", "type": "float", "value": layer.cameraMultY },
+                ],
+            }
+            layer_id += 1
+
+            if layer.isUsingStaticVertexBuffer != 0:
+                # Rows are stored bottom-up
+                tiledLayer["offsetx"] = 0.0
+                tiledLayer["offsety"] = 0.0
+                tile = svbTiles.tiles[layer.startY:layer.endY + 1][::-1, :layer.endX - layer.startX + 1]
+                tiledLayer["data"] = np.where(tile != 0, tile + GetTiledLayerGIDOffset(ltb, layer, tilesets), 0)
+            else:
+                layerTiles = DecodeLayerTiles(ltb, layer)
+
+                tiled_out = layerTiles.ids.astype(np.uint32)
+                nonEmpty = tiled_out != 0
+                tiled_out[nonEmpty] += GetTiledLayerGIDOffset(ltb, layer, tilesets)
+
+                tiled_out[layerTiles.flipX & nonEmpty] |= 0x80000000
+                tiled_out[layerTiles.flipY & nonEmpty] |= 0x40000000
+
+                tiledLayer["chunks"] = []
+                for cy, cx in zip(*np.nonzero(layerTiles.chunks)):
+                    tiledLayer["chunks"].append({
+                        "x": int(cx) * 16,
+                        "y": int(cy) * 16,
+                        "width": 16,
+                        "height": 16,
+                        "data": tiled_out[cy * 16:(cy + 1) * 16, cx * 16:(cx + 1) * 16],
+                    })
+
+            for writer in writers:
+                writer.write_layer(tiledLayer)
+
+        for b in range(len(lvb.rectangleBatchList)):
+            batch = lvb.rectangleBatchList[b]
+            objectGroup = { "type": "objectgroup", "id": layer_id, "visible": False, "objects": [] }
+            if batch.hash in parameterMap.keys():
+                print(parameterMap[batch.hash])
+                objectGroup["name"] = parameterMap[batch.hash]
+            else:
+                objectGroup["name"] = "Rect Layer %08X" % batch.hash
+            layer_id += 1
+            for r in range(batch.start, batch.start + batch.count):
+                recta = lvb.rectangleInfoList[r]
+                objectGroup["objects"].append({ "x": recta.x, "y": recta.y, "width": recta.width, "height": recta.height, "id": recta.id })
+                object_id = recta.id + 1
+            for writer in writers:
+                writer.write_layer(objectGroup)
+
+        # parameterMap
+        objectGroup = { "type": "objectgroup", "id": layer_id, "name": "Object Layer %08X" % 0xDEADBEEF, "visible": True, "objects": [] }
         layer_id += 1
-        for r in range(batch.start, batch.start + batch.count):
-            recta = lvb.rectangleInfoList[r]
-            xml_object = SubElement(xml_objectgroup, "object")
-            xml_object.set("x", str(recta.x))
-            xml_object.set("y", str(recta.y))
-            xml_object.set("width", str(recta.width))
-            xml_object.set("height", str(recta.height))
-            xml_object.set("id", str(recta.id))
-            object_id = recta.id + 1
-
-    # parameterMap
-    xml_objectgroup = SubElement(xml_map, "objectgroup")
-    xml_objectgroup.set("id", str(layer_id))
-    xml_objectgroup.set("name", "Object Layer %08X" % 0xDEADBEEF)
-    layer_id += 1
-
-    unk7s = {}
-    # self.objectInfo = namedtuple("ObjectInfo", "unkHash layerNameHash x y scalex scaley unk6 objectID unk7 gID propertyCount propertyIndexStart unk11")
 
-    for i in range(len(lvb.objectInfoList)):
-        object = lvb.objectInfoList[i]
-        oID = object.objectID & 0xFFF
+        unk7s = {}
+        # self.objectInfo = namedtuple("ObjectInfo", "unkHash layerNameHash x y scalex scaley unk6 objectID unk7 gID propertyCount propertyIndexStart unk11")
 
-        xml_object = SubElement(xml_objectgroup, "object")
-        xml_object.set("x", str(object.x))
-        xml_object.set("y", str(object.y))
-        if oID in objectNameDict.keys():
-            xml_object.set("name", objectNameDict[oID])
-        else:
-            xml_object.set("name", "UnknownObject %d" % oID)
-        xml_object.set("id", str(object.gID & 0xFFFF))
-        xml_point = SubElement(xml_object, "point")
-        object_id += 1
-
-        unk7s[object.unk7] = object.unk7
-
-        xml_properties = SubElement(xml_object, "properties")
-
-        p_count = lvb.objectPropertyCountMap[oID]
-        p_start = object.propertyIndexStart
-        p_end = p_start + object.propertyCount
-        for p in range(p_start, p_end):
-            valueSet = lvb.propertyValueSetList[p]
-            property_name = "0x%08X" % valueSet.hash
-            property_value = ""
-            if valueSet.hash in parameterMap.keys():
-                property_name = parameterMap[valueSet.hash]
-            if valueSet.stringOffset in lvb.valueStringListMap.keys():
-                property_value = lvb.valueStringListMap[valueSet.stringOffset]
-
-            xml_property = SubElement(xml_properties, "property")
-            xml_property.set("name", property_name)
-            xml_property.set("type", "string")
-            xml_property.set("value", property_value)
+        for i in range(len(lvb.objectInfoList)):
+            object = lvb.objectInfoList[i]
+            oID = object.objectID & 0xFFF
 
-    print("unk7s")
-    for u in unk7s.keys():
-        print("u: %d" % u)
+            tiledObject = { "x": object.x, "y": object.y }
+            if oID in objectNameDict.keys():
+                tiledObject["name"] = objectNameDict[oID]
+            else:
+                tiledObject["name"] = "UnknownObject %d" % oID
+            tiledObject["id"] = object.gID & 0xFFFF
+            tiledObject["point"] = True
+            tiledObject["properties"] = []
+            object_id += 1
+
+            unk7s[object.unk7] = object.unk7
+
+            p_count = lvb.objectPropertyCountMap[oID]
+            p_start = object.propertyIndexStart
+            p_end = p_start + object.propertyCount
+            for p in range(p_start, p_end):
+                valueSet = lvb.propertyValueSetList[p]
+                property_name = "0x%08X" % valueSet.hash
+                property_value = ""
+                if valueSet.hash in parameterMap.keys():
+                    property_name = parameterMap[valueSet.hash]
+                if valueSet.stringOffset in lvb.valueStringListMap.keys():
+                    property_value = lvb.valueStringListMap[valueSet.stringOffset]
+
+                tiledObject["properties"].append({ "name": property_name, "type": "string", "value": property_value })
+
+            objectGroup["objects"].append(tiledObject)
+
+        print("unk7s")
+        for u in unk7s.keys():
+            print("u: %d" % u)
+
+        for writer in writers:
+            writer.write_layer(objectGroup)
+            writer.close(layer_id, object_id)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+
+    textureKey = ltb.get_hash() + stage_name
+    if cache != None and cache.is_current("tiled_textures", textureKey):
+        print("Tiled textures are up to date")
+        texture_paths = cache.entries["tiled_textures"]["outputs"]
+    else:
+        paletteInfo = ltb.textureFormatInfoList[0]
+        paletteBytes = ltb.get_attached_file(0)
+
+        print("width %d height %d size %d" % (paletteInfo.width, paletteInfo.height, paletteInfo.size))
+
+        texture_paths = []
+        for i in range(len(ltb.attachedFileList)):
+            info = ltb.textureFormatInfoList[i]
+            bytearr = ltb.get_attached_file(i)
+            image = None
+            if info.isCompressed != 0:
+                if info.width * info.height * 4 == len(bytearr):
+                    image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearr), 'raw')
+                else:
+                    bytearrRGBA = [0] * len(bytearr) * 4
+                    for c in range(len(bytearr)):
+                        cp = int(bytearr[c] * 32 / 255) << 2
+                        bytearrRGBA[c * 4 + 0] = paletteBytes[cp + 0]
+                        bytearrRGBA[c * 4 + 1] = paletteBytes[cp + 1]
+                        bytearrRGBA[c * 4 + 2] = paletteBytes[cp + 2]
+                        bytearrRGBA[c * 4 + 3] = paletteBytes[cp + 3]
+                    image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearrRGBA), 'raw')
+            else:
+                if info.width * info.height * 4 == len(bytearr):
+                    image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearr), 'raw')
 
-    open("../Scenes/" + map_name + ".tmx", "w").write(prettifyXML(xml_map))
+            if image != None:
+                texture_path = folder + "/" + stage_name + "_%d.png" % i
+                image.save(texture_path)
+                texture_paths.append(texture_path)
 
-    paletteInfo = ltb.textureFormatInfoList[0]
-    ltb.file.seek(ltb.ltb_start + ltb.attachedFileList[0])
-    paletteBytes = ltb.file.read(paletteInfo.size)
+        for tileset in tilesets:
+            texture_paths.append(WriteTiledTileset(ltb, tileset, folder))
 
-    print("width %d height %d size %d" % (paletteInfo.width, paletteInfo.height, paletteInfo.size))
+        if cache != None:
+            cache.set("tiled_textures", textureKey, None, texture_paths)
+    print("")
 
-    wflz = WFLZ()
-    for i in range(len(ltb.attachedFileList)):
-        ltb.file.seek(ltb.ltb_start + ltb.attachedFileList[i])
+    if cache != None:
+        cache.set("tiled", stageKey, None, list(map_paths.values()) + texture_paths)
+        cache.save()
+
+    # Saved last, the map is complete even if the name database can't be written
+    if addedNames > 0:
+        SaveNameDatabase(nameDatabase)
+
+# Finds every .ltb under 'folder' that has a matching .lvb next to it
+def FindStages(folder):
+    stages = []
+    for ltbPath in sorted(Path(folder).rglob("*.ltb")):
+        lvbPath = ltbPath.with_suffix(".lvb")
+        if lvbPath.is_file():
+            stages.append((ltbPath, lvbPath))
+    return stages
+
+# Converts one stage into 'folder', the converters' output goes to folder/log.txt.
+# Unless 'rebuild' is set, steps whose inputs didn't change since the last run are skipped.
+def ConvertStage(ltbPath, lvbPath, folder, targets = ("tiled",), rebuild = False, encoding = "csv", formats = ("tmx",)):
+    startTime = perf_counter()
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    cache = BuildCache(folder + "/" + "buildcache.json")
+    if rebuild:
+        cache.entries = { }
+    with open(folder + "/" + "log.txt", "w") as log, redirect_stdout(log):
+        try:
+            with LTBClass(ltbPath) as ltb, LVBClass(lvbPath) as lvb:
+                if "tiled" in targets:
+                    LTBandLVBtoTiled(ltb, lvb, folder + "/" + "Tiled", cache, encoding, formats, Path(ltbPath).stem)
+                if "rsdk" in targets:
+                    LTBandLVBtoRSDKScene(ltb, lvb, folder + "/" + "RSDK", cache)
+        except (Exception, SystemExit):
+            traceback.print_exc(file=log)
+            raise
+    return perf_counter() - startTime
+
+# Converts every stage found under 'gameFolder' in parallel, one output folder per stage
+def BatchConvert(gameFolder, outputFolder, workers = None, targets = ("tiled",), rebuild = False, encoding = "csv", formats = ("tmx",)):
+    stages = FindStages(gameFolder)
+    print("Found %d stages in '%s'" % (len(stages), gameFolder))
+
+    startTime = perf_counter()
+    timings = { }
+    failures = { }
+    with ProcessPoolExecutor(workers) as executor:
+        futures = { }
+        for ltbPath, lvbPath in stages:
+            stageName = str(ltbPath.relative_to(gameFolder).with_suffix(""))
+            stageFolder = str(Path(outputFolder) / stageName)
+            futures[executor.submit(ConvertStage, ltbPath, lvbPath, stageFolder, targets, rebuild, encoding, formats)] = stageName
+        for future in as_completed(futures):
+            stageName = futures[future]
+            try:
+                timings[stageName] = future.result()
+                print("Converted %s (%.2fs)" % (stageName, timings[stageName]))
+            # _exit() in a worker comes back as SystemExit, which must not end the batch
+            except (Exception, SystemExit) as e:
+                failures[stageName] = "".join(traceback.format_exception_only(type(e), e)).strip()
+                print("Failed %s" % (stageName))
 
-        info = ltb.textureFormatInfoList[i]
-        if info.isCompressed != 0:
-            bytearr = wflz.decomp_file(ltb.file)
+    print("")
+    print("Batch Summary:")
+    print("--------------")
+    for stageName in sorted(timings.keys()):
+        print("%s: %.2fs" % (stageName, timings[stageName]))
+    if len(failures) > 0:
+        print("")
+        print("Failed:")
+        for stageName in sorted(failures.keys()):
+            print("%s: %s" % (stageName, failures[stageName]))
+    print("")
+    print("Converted %d / %d stages in %.2fs" % (len(timings), len(stages), perf_counter() - startTime))
+    return failures
+
+# Affixes tried around every candidate word when cracking YCG hashes
+YCG_CRACK_PREFIXES = [ "", "PF_", "BG_", "collision_", "COLLISION_", "no_", "death_" ]
+YCG_CRACK_SUFFIXES = [
+    "", "_SHOVEL", "_shovel", "_PLAGUE", "_SPECTER", "_KING", "_fancy", "_fancy2", "_Fancy", "_Fancy2",
+    "_FANCY", "_FANCY2", "_HAZARD", "_SOFT", "_hard", "_soft", "_BG", "_FG", "_L", "_R", "_X", "_Y",
+    "_2", "2", "3", "4", "_TIME", "_MIN", "_MAX", "_OFFSET", "_SPEED", "_RANGE",
+]
+
+# Collects every hash used in the LVBs under 'gameFolder' that 'nameDatabase' can't resolve,
+# along with candidate words found in the LTB layer names and LVB value strings
+def CollectUnresolvedHashes(gameFolder, nameDatabase):
+    unresolved = { }
+    words = set()
+    skipped = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for ltbPath in sorted(Path(gameFolder).rglob("*.ltb")):
+            try:
+                with LTBClass(ltbPath) as ltb:
+                    for layer in ltb.layerInfoList:
+                        words.add(layer.name.decode("utf8", "replace").split('\0', 1)[0])
+            except Exception:
+                skipped.append(ltbPath)
+        for lvbPath in sorted(Path(gameFolder).rglob("*.lvb")):
+            try:
+                with LVBClass(lvbPath) as lvb:
+                    hashes = [batch.hash for batch in lvb.rectangleBatchList]
+                    hashes += [valueSet.hash for valueSet in lvb.propertyValueSetList]
+                    hashes += [object.layerNameHash for object in lvb.objectInfoList]
+                    strings = list(lvb.valueStringListMap.values())
+            except Exception:
+                skipped.append(lvbPath)
+                continue
+            for hash in hashes:
+                if nameDatabase.get(hash) == None:
+                    unresolved[hash] = unresolved.get(hash, 0) + 1
+            for string in strings:
+                words.add(string)
+                words.update(re.split(r"[^A-Za-z0-9_]+", string))
+    for path in skipped:
+        print("Warning: Could not read '%s', skipping." % (path))
+    words.discard("")
+    return unresolved, words
+
+def _ycg_crack_init(targets, prefixes, suffixes):
+    global _ycgCrackTargets, _ycgCrackPrefixes, _ycgCrackSuffixes
+    _ycgCrackTargets = targets
+    _ycgCrackPrefixes = prefixes
+    _ycgCrackSuffixes = suffixes
+
+# Tries every affix and case combination of 'words', returns the matches and how many names were hashed.
+def _ycg_crack_words(words):
+    targets = _ycgCrackTargets
+    found = []
+    count = 0
+    for word in words:
+        for variant in { word, word.upper(), word.lower() }:
+            for prefix in _ycgCrackPrefixes:
+                for suffix in _ycgCrackSuffixes:
+                    name = prefix + variant + suffix
+                    hash = YCG_Hash(name, len(name), YCG_HASH_SEED)
+                    if hash in targets:
+                        found.append((hash, name))
+            count += len(_ycgCrackPrefixes) * len(_ycgCrackSuffixes)
+    return found, count
+
+# Dictionary attack on the unresolved YCG hashes of a game dump, results go to the shared name database
+def CrackYCGHashes(gameFolder, wordlistPaths = [], workers = None, chunkSize = 256):
+    nameDatabase = YCGNameDatabase()
+    unresolved, words = CollectUnresolvedHashes(gameFolder, nameDatabase)
+    words.update(nameDatabase.names.values())
+    for wordlistPath in wordlistPaths:
+        with open(wordlistPath, "r", encoding="utf8", errors="replace") as file:
+            words.update(line.strip() for line in file)
+    words = sorted(word for word in words if word != "" and word.isascii())
+
+    workers = workers or os.cpu_count()
+    print("Cracking %d unresolved hashes with %d words and %d affix combinations on %d workers" % (len(unresolved), len(words), len(YCG_CRACK_PREFIXES) * len(YCG_CRACK_SUFFIXES), workers))
+    if len(unresolved) == 0:
+        return { }
+
+    startTime = perf_counter()
+    hashCount = 0
+    cracked = { }
+    initargs = (frozenset(unresolved.keys()), YCG_CRACK_PREFIXES, YCG_CRACK_SUFFIXES)
+    with ProcessPoolExecutor(workers, initializer=_ycg_crack_init, initargs=initargs) as executor:
+        chunks = [words[i:i + chunkSize] for i in range(0, len(words), chunkSize)]
+        for found, count in executor.map(_ycg_crack_words, chunks):
+            hashCount += count
+            for hash, name in found:
+                if not hash in cracked:
+                    cracked[hash] = name
+                    nameDatabase.add(hash, name)
+                    print("Found 0x%08X: %s" % (hash, name))
+    elapsed = perf_counter() - startTime
+
+    if len(cracked) > 0:
+        nameDatabase.save()
 
-            if info.width * info.height * 4 == len(bytearr):
-                image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearr), 'raw')
-                image.save("file_name_%d.png" % i)
-            else:
-                bytearrRGBA = [0] * len(bytearr) * 4
-                for c in range(len(bytearr)):
-                    cp = int(bytearr[c] * 32 / 255) << 2
-                    bytearrRGBA[c * 4 + 0] = paletteBytes[cp + 0]
-                    bytearrRGBA[c * 4 + 1] = paletteBytes[cp + 1]
-                    bytearrRGBA[c * 4 + 2] = paletteBytes[cp + 2]
-                    bytearrRGBA[c * 4 + 3] = paletteBytes[cp + 3]
-                image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearrRGBA), 'raw')
-                image.save("file_name_%d.png" % i)
-        else:
-            bytearr = ltb.file.read(info.size)
-            if info.width * info.height * 4 == len(bytearr):
-                image = Image.frombytes('RGBA', (info.width, info.height), bytes(bytearr), 'raw')
-                image.save("file_name_%d.png" % i)
     print("")
+    print("Hashed %d names in %.2fs (%d hashes/s per core)" % (hashCount, elapsed, hashCount / max(elapsed, 1e-9) / workers))
+    print("Resolved %d / %d hashes" % (len(cracked), len(unresolved)))
+    return cracked
 
 if __name__ == '__main__':
+    # Tiled tile data encoding: --encoding=<csv|base64|zlib|gzip|zstd>
+    encoding = "csv"
+    for arg in [arg for arg in sys.argv if arg.startswith("--encoding=")]:
+        encoding = arg.split("=", 1)[1]
+        sys.argv.remove(arg)
+    if not encoding in TILED_DATA_ENCODINGS:
+        _exit("Error: Unknown tile data encoding '%s'." % (encoding))
+    if encoding == "zstd" and zstandard == None:
+        _exit("Error: zstd tile data encoding requires the 'zstandard' package.")
+
+    # Tiled map formats: --formats=<tmx,tmj>
+    formats = ("tmx",)
+    for arg in [arg for arg in sys.argv if arg.startswith("--formats=")]:
+        formats = tuple(arg.split("=", 1)[1].split(","))
+        sys.argv.remove(arg)
+    for format in formats:
+        if not format in TILED_MAP_WRITERS:
+            _exit("Error: Unknown map format '%s'." % (format))
+
+    # Batch mode: --batch <game folder> [output folder] [workers] [--rsdk] [--rebuild] [--encoding=..] [--formats=..]
+    if len(sys.argv) >= 2 and sys.argv[1] == "--batch":
+        args = [arg for arg in sys.argv[2:] if not arg in ["--rsdk", "--rebuild"]]
+        targets = ("tiled", "rsdk") if "--rsdk" in sys.argv else ("tiled",)
+        rebuild = "--rebuild" in sys.argv
+        if not len(args) >= 1:
+            _exit("Error: Please specify a game folder.")
+        if not Path(args[0]).is_dir():
+            _exit("Error: The folder '%s' was not found." % (args[0]))
+        outputFolder = args[1] if len(args) >= 2 else "Output"
+        workers = int(args[2]) if len(args) >= 3 else None
+
+        failures = BatchConvert(Path(args[0]), outputFolder, workers, targets, rebuild, encoding, formats)
+        print("Log: Program finished.")
+        sys.exit(1 if len(failures) > 0 else 0)
+
+    # Hash cracking mode: --crack <game folder> [wordlist files..]
+    if len(sys.argv) >= 2 and sys.argv[1] == "--crack":
+        if not len(sys.argv) >= 3:
+            _exit("Error: Please specify a game folder.")
+        if not Path(sys.argv[2]).is_dir():
+            _exit("Error: The folder '%s' was not found." % (sys.argv[2]))
+        for wordlistPath in sys.argv[3:]:
+            if not Path(wordlistPath).is_file():
+                _exit("Error: The file '%s' was not found." % (wordlistPath))
+
+        CrackYCGHashes(Path(sys.argv[2]), sys.argv[3:])
+        print("Log: Program finished.")
+        sys.exit(0)
+
     # Verify the file exist and an arg was giving
     if not len(sys.argv) >= 2:
         _exit("Error: Please specify a target .ltb file.")
@@ -2600,11 +3819,20 @@ if __name__ == '__main__':
     if not Path(sys.argv[2]).is_file() and not Path(sys.argv[2]).is_dir():
         _exit("Error: The file '%s' was not found." % (sys.argv[2]))
 
+    # Optional output folder and stage name: <ltb> <lvb> [output folder] [--name=<stage name>]
+    stageName = None
+    for arg in [arg for arg in sys.argv if arg.startswith("--name=")]:
+        stageName = arg.split("=", 1)[1]
+        sys.argv.remove(arg)
+    outputFolder = sys.argv[3] if len(sys.argv) >= 4 else None
+
     # Run it
     # os.chdir(Path(sys.argv[1]).parent)
     ltb = LTBClass(Path(sys.argv[1]))
     lvb = LVBClass(Path(sys.argv[2]))
-    LTBandLVBtoTiled(ltb, lvb)
+    LTBandLVBtoTiled(ltb, lvb, outputFolder, encoding=encoding, formats=formats, stage_name=stageName)
     # LTBandLVBtoRSDKScene(ltb, lvb, "Plains")
+    ltb.close()
+    lvb.close()
 
-_exit("Log: Program finished.")
+    _exit("Log: Program finished.")